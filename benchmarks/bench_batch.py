@@ -0,0 +1,193 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the batch API against a local swift stand-in.
+
+The server is run in a local WSGI (or ASGI) server and driven with
+download and upload batches of varying size and concurrency. For every
+scenario, the latency percentiles, the throughput and the peak RSS of the
+process are reported. Run from the repository root, e.g.:
+
+    python -m benchmarks.bench_batch --latency 0.005 --sizes 1 100 1000 \
+        --concurrency 1 8 --set BATCH_WORKERS=16
+"""
+
+import argparse
+import ast
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import resource
+import threading
+import time
+
+import requests
+from werkzeug.serving import make_server
+
+from git_lfs_swift_server import app
+
+from tests.fake_swift import FakeSwift, oid
+
+USER = 'bench:bench'
+PASSWORD = 'secret'
+
+
+def percentile(values, p):
+    """Return the p-th percentile of values."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * len(values))))]
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in MiB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024.0
+
+
+class Server(object):
+    """Run the Flask app in a threaded local WSGI server."""
+
+    def __init__(self):
+        self._server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_port)
+
+    def __enter__(self):
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+
+
+class ASGIServer(object):
+    """Run the ASGI app in a local uvicorn server."""
+
+    def __init__(self):
+        import socket
+        import uvicorn
+        from git_lfs_swift_server.asgi import app as asgi_app
+
+        self._socket = socket.socket()
+        self._socket.bind(('127.0.0.1', 0))
+        self.url = 'http://127.0.0.1:{}'.format(
+            self._socket.getsockname()[1])
+        self._server = uvicorn.Server(uvicorn.Config(
+            asgi_app, log_level='warning', lifespan='on'))
+
+    def __enter__(self):
+        thread = threading.Thread(
+            target=self._server.run, kwargs={'sockets': [self._socket]})
+        thread.daemon = True
+        thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.should_exit = True
+
+
+def run_scenario(url, operation, size, concurrency, batches):
+    """Send batches and return (latencies, errors, duration)."""
+    session = requests.Session()
+    headers = {
+        'Authorization': 'Basic ' + b64encode(
+            (USER.replace(':', ';') + ':' + PASSWORD).encode()).decode(),
+        'Content-Type': 'application/json'}
+    # Downloads ask for existing objects, uploads for new ones.
+    start = 0 if operation == 'download' else 10 ** 9
+    bodies = [
+        json.dumps({'operation': operation, 'objects': [
+            {'oid': oid(start + (n * size + i) % 10 ** 6), 'size': 1}
+            for i in range(size)]})
+        for n in range(batches)]
+
+    def send(body):
+        t = time.time()
+        r = session.post(url + '/lfs/objects/batch', data=body,
+                         headers=headers)
+        return time.time() - t, r.status_code
+
+    t = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, bodies))
+    duration = time.time() - t
+    return ([r[0] for r in results],
+            sum(1 for r in results if r[1] != 200), duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='latency of the swift stand-in in seconds')
+    parser.add_argument('--objects', type=int, default=20000,
+                        help='number of objects in the container')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1, 10, 100, 1000])
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 8])
+    parser.add_argument('--batches', type=int, default=20,
+                        help='number of batches per scenario')
+    parser.add_argument('--operations', nargs='+',
+                        default=['download', 'upload'])
+    parser.add_argument('--write-only', action='store_true',
+                        help='forbid reads, so that uploads are probed')
+    parser.add_argument('--asgi', action='store_true',
+                        help='benchmark the ASGI app (requires uvicorn)')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='server setting, e.g. BATCH_WORKERS=16')
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    swift = FakeSwift(latency=args.latency, users={USER: PASSWORD},
+                      forbidden=['lfs'] if args.write_only else [])
+    swift.populate('AUTH_bench', 'lfs', args.objects)
+    app.config['AUTH_URL'] = swift.auth_url
+    for setting in args.set:
+        key, value = setting.split('=', 1)
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        app.config[key] = value
+
+    print('swift latency {}s, {}'.format(
+        args.latency, ', '.join(args.set) or 'default settings'))
+    print('{:<9} {:>6} {:>5} {:>9} {:>9} {:>9} {:>10} {:>6} {:>9}'.format(
+        'operation', 'size', 'conc', 'p50 [ms]', 'p99 [ms]', 'batch/s',
+        'objects/s', 'errors', 'rss [MiB]'))
+    with swift, (ASGIServer() if args.asgi else Server()) as server:
+        for operation in args.operations:
+            for size in args.sizes:
+                for concurrency in args.concurrency:
+                    latencies, errors, duration = run_scenario(
+                        server.url, operation, size, concurrency,
+                        args.batches)
+                    print('{:<9} {:>6} {:>5} {:>9.1f} {:>9.1f} {:>9.1f} '
+                          '{:>10.0f} {:>6} {:>9.1f}'.format(
+                              operation, size, concurrency,
+                              percentile(latencies, 50) * 1000,
+                              percentile(latencies, 99) * 1000,
+                              len(latencies) / duration,
+                              len(latencies) * size / duration,
+                              errors, peak_rss()))
+
+
+if __name__ == '__main__':
+    main()
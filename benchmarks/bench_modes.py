@@ -0,0 +1,125 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the throughput of the serving modes of the command line.
+
+The server is started with git-lfs-swift-server in every mode against a
+local swift stand-in and driven with download batches. Run from the
+repository root, e.g.:
+
+    python -m benchmarks.bench_modes --latency 0.005 --workers 2 \
+        --concurrency 1 16 64
+"""
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from tests.fake_swift import FakeSwift
+
+from .bench_batch import PASSWORD, USER, percentile, run_scenario
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class ModeServer(object):
+    """Run the command line in a mode in a subprocess."""
+
+    def __init__(self, mode, settings, workers):
+        port = free_port()
+        self.url = 'http://127.0.0.1:{}'.format(port)
+        self._args = [sys.executable, '-m', 'git_lfs_swift_server',
+                      '--mode', mode, '--settings', settings,
+                      '--bind', '127.0.0.1:{}'.format(port),
+                      '--workers', str(workers)]
+        self._port = port
+
+    def __enter__(self):
+        self._process = subprocess.Popen(
+            self._args, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            try:
+                socket.create_connection(
+                    ('127.0.0.1', self._port), timeout=1).close()
+                return self
+            except OSError:
+                time.sleep(0.1)
+        self._process.kill()
+        raise RuntimeError('{} did not start.'.format(' '.join(self._args)))
+
+    def __exit__(self, *exc_info):
+        self._process.terminate()
+        self._process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='latency of the swift stand-in in seconds')
+    parser.add_argument('--objects', type=int, default=20000,
+                        help='number of objects in the container')
+    parser.add_argument('--size', type=int, default=100,
+                        help='number of objects per batch')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 16, 64])
+    parser.add_argument('--batches', type=int, default=100,
+                        help='number of batches per scenario')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='number of worker processes')
+    parser.add_argument('--modes', nargs='+',
+                        default=['prefork', 'threaded', 'gevent'])
+    args = parser.parse_args()
+
+    swift = FakeSwift(latency=args.latency, users={USER: PASSWORD})
+    swift.populate('AUTH_bench', 'lfs', args.objects)
+    with tempfile.NamedTemporaryFile('w', suffix='.py') as settings:
+        settings.write('AUTH_URL = {!r}\n'.format(swift.auth_url))
+        settings.flush()
+        os.environ.setdefault('PYTHONPATH', os.getcwd())
+
+        print('swift latency {}s, {} objects per batch, {} workers'.format(
+            args.latency, args.size, args.workers))
+        print('{:<9} {:>5} {:>9} {:>9} {:>9} {:>6}'.format(
+            'mode', 'conc', 'p50 [ms]', 'p99 [ms]', 'batch/s', 'errors'))
+        with swift:
+            for mode in args.modes:
+                with ModeServer(mode, settings.name, args.workers) as server:
+                    # Warm up the connections and caches of the workers.
+                    run_scenario(server.url, 'download', args.size,
+                                 args.workers, args.workers * 4)
+                    for concurrency in args.concurrency:
+                        latencies, errors, duration = run_scenario(
+                            server.url, 'download', args.size,
+                            concurrency, args.batches)
+                        print('{:<9} {:>5} {:>9.1f} {:>9.1f} {:>9.1f} '
+                              '{:>6}'.format(
+                                  mode, concurrency,
+                                  percentile(latencies, 50) * 1000,
+                                  percentile(latencies, 99) * 1000,
+                                  len(latencies) / duration, errors))
+
+
+if __name__ == '__main__':
+    main()
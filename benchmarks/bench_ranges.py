@@ -0,0 +1,112 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark downloads of large objects in byte ranges.
+
+A large object is downloaded from a local swift stand-in with a limited
+bandwidth per stream, once as a whole and once in the byte ranges returned
+by the batch API with DOWNLOAD_PART_SIZE set, fetched concurrently. Run from
+the repository root, e.g.:
+
+    python -m benchmarks.bench_ranges --size 64 --bandwidth 16 \
+        --part-size 8 --concurrency 1 4 8
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import time
+
+import requests
+
+from git_lfs_swift_server import app
+
+from benchmarks.bench_batch import PASSWORD, Server, USER
+from tests.fake_swift import FakeSwift, oid
+
+MIB = 1024 * 1024
+
+
+def batch(url, size):
+    """Return the download action of the large object."""
+    r = requests.post(
+        url + '/lfs/objects/batch', auth=(USER.replace(':', ';'), PASSWORD),
+        headers={'Content-Type': 'application/json'},
+        data=json.dumps({'operation': 'download',
+                         'objects': [{'oid': oid(0), 'size': size}]}))
+    r.raise_for_status()
+    return r.json()['objects'][0]['actions']['download']
+
+
+def download(session, href, header):
+    """Download href and return the number of bytes received."""
+    received = 0
+    with session.get(href, headers=header, stream=True) as r:
+        r.raise_for_status()
+        for chunk in r.iter_content(65536):
+            received += len(chunk)
+    return received
+
+
+def download_parts(action, concurrency):
+    """Download the ranges of action with concurrency streams."""
+    session = requests.Session()
+    parts = action.get('parts') or [action]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return sum(executor.map(
+            lambda p: download(session, p['href'], p['header']), parts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=64,
+                        help='object size in MiB')
+    parser.add_argument('--bandwidth', type=float, default=16,
+                        help='bandwidth per stream of the stand-in in MiB/s')
+    parser.add_argument('--part-size', type=int, default=8,
+                        help='DOWNLOAD_PART_SIZE in MiB')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 4, 8])
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    size = args.size * MIB
+    swift = FakeSwift(users={USER: PASSWORD},
+                      bandwidth=args.bandwidth * MIB)
+    swift.populate('AUTH_bench', 'lfs', 1, size=size)
+    app.config['AUTH_URL'] = swift.auth_url
+    app.config['DOWNLOAD_PART_SIZE'] = args.part_size * MIB
+
+    print('object {} MiB, {} MiB/s per stream, parts of {} MiB'.format(
+        args.size, args.bandwidth, args.part_size))
+    print('{:<7} {:>5} {:>6} {:>9} {:>7}'.format(
+        'mode', 'conc', 'parts', 'time [s]', 'MiB/s'))
+    with swift, Server() as server:
+        action = batch(server.url, size)
+        scenarios = [('single', 1, dict(action, parts=None))] + [
+            ('ranges', c, action) for c in args.concurrency]
+        for mode, concurrency, a in scenarios:
+            t = time.time()
+            received = download_parts(a, concurrency)
+            duration = time.time() - t
+            assert received == size, received
+            print('{:<7} {:>5} {:>6} {:>9.2f} {:>7.1f}'.format(
+                mode, concurrency, len(a.get('parts') or [a]), duration,
+                received / float(MIB) / duration))
+
+
+if __name__ == '__main__':
+    main()
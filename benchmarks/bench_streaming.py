@@ -0,0 +1,106 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare memory and latency of buffered and streamed batch responses.
+
+Swift is replaced by a mock, so that only request parsing, the batch logic
+and serialization are measured. Run from the repository root:
+
+    python -m benchmarks.bench_streaming --objects 20000 --chunk 1000
+"""
+
+import argparse
+from base64 import b64encode
+import hashlib
+import json
+import time
+import tracemalloc
+
+from mock import Mock, patch
+
+from git_lfs_swift_server import app
+
+MODES = [
+    ('buffered', {}),
+    ('streaming', {'BATCH_STREAMING': True}),
+    ('streaming+orjson', {'BATCH_STREAMING': True, 'JSON_BACKEND': 'orjson'}),
+    ('streaming+gzip', {'BATCH_STREAMING': True, 'BATCH_GZIP': True}),
+]
+
+
+def make_batch(n):
+    """Return the JSON body of a download batch with n objects."""
+    objects = [
+        {'oid': hashlib.sha256(str(i).encode()).hexdigest(), 'size': 1}
+        for i in range(n)]
+    return json.dumps({'operation': 'download', 'transfers': ['basic'],
+                       'objects': objects})
+
+
+def run(client, body, config):
+    """Return (time to first byte, total time, peak memory, body size)."""
+    app.config.update(config)
+    headers = {
+        'Authorization': 'Basic ' + b64encode(b'user:password').decode(),
+        'Content-Type': 'application/json', 'Accept-Encoding': 'gzip'}
+    tracemalloc.start()
+    start = time.time()
+    r = client.post('/container/objects/batch', data=body, headers=headers,
+                    buffered=False)
+    chunks = iter(r.response)
+    size = len(next(chunks))
+    ttfb = time.time() - start
+    for chunk in chunks:
+        size += len(chunk)
+    total = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    r.close()
+    for key in config:
+        app.config.pop(key)
+    return ttfb, total, peak, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--objects', type=int, default=20000,
+                        help='number of objects per batch')
+    parser.add_argument('--chunk', type=int, default=1000,
+                        help='objects per streamed chunk '
+                             '(BATCH_STREAMING_CHUNK)')
+    args = parser.parse_args()
+    n = args.objects
+    app.config['AUTH_URL'] = ''
+    app.config['BATCH_STREAMING_CHUNK'] = args.chunk
+    client = app.test_client()
+    body = make_batch(n)
+
+    print('{} objects, request size {} bytes'.format(n, len(body)))
+    print('{:<18} {:>10} {:>10} {:>12} {:>12}'.format(
+        'mode', 'ttfb [s]', 'total [s]', 'peak [MiB]', 'size [B]'))
+    # A plain function, because mocks remember all their calls.
+    response = Mock(headers={'content-length': 1})
+    with patch('git_lfs_swift_server.server.client.get_auth',
+               Mock(return_value=('http://swift/v1/AUTH_a', 'token'))), \
+            patch('git_lfs_swift_server.swift.requests.Session.head',
+                  lambda self, url, **kwargs: response):
+        for name, config in MODES:
+            ttfb, total, peak, size = run(client, body, config)
+            print('{:<18} {:>10.3f} {:>10.3f} {:>12.1f} {:>12}'.format(
+                name, ttfb, total, peak / 2.0 ** 20, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Replay captured batch requests against a local swift stand-in.
+
+Requests captured with CAPTURE_FILE are sent to the server at their
+original pace, divided by --speedup, with at most --concurrency requests
+at the same time. The objects of captured downloads are created in the
+stand-in beforehand, so that downloads find them and uploads don't. For
+every operation, the latency distribution and the error rate are
+reported. Run from the repository root, e.g.:
+
+    python -m benchmarks.replay capture.jsonl --speedup 10 \
+        --concurrency 32 --set BATCH_WORKERS=16
+"""
+
+import argparse
+import ast
+from base64 import b64encode
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import threading
+import time
+
+import requests
+
+from git_lfs_swift_server import app
+
+from benchmarks.bench_batch import (
+    ASGIServer, PASSWORD, peak_rss, percentile, Server, USER)
+from tests.fake_swift import FakeSwift
+
+ACCOUNT = 'AUTH_' + USER.split(':')[0]
+
+
+def load(path):
+    """Return the captured records of path, ordered by time."""
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return sorted(records, key=lambda r: r['time'])
+
+
+def populate(swift, records):
+    """Create the objects of the captured downloads in swift."""
+    for record in records:
+        if record['operation'] != 'download':
+            continue
+        objects = swift.objects.setdefault(
+            (ACCOUNT, record['container']), {})
+        for oid, size in record['objects']:
+            if isinstance(oid, str) and isinstance(size, int):
+                objects[oid] = size
+
+
+def request(record):
+    """Return the path, body and headers to replay record."""
+    container = record['container']
+    headers = {'Content-Type': 'application/json'}
+    if record['route'] == 'tempurl':
+        # The swift stand-in does not verify signatures.
+        path = '/{}/{}/read_sig/write_sig/{}/objects/batch'.format(
+            ACCOUNT, container, int(time.time()) + 3600)
+    else:
+        headers['Authorization'] = 'Basic ' + b64encode(
+            (USER.replace(':', ';') + ':' + PASSWORD).encode()).decode()
+        if record['route'] == 'account':
+            path = '/{}/{}/objects/batch'.format(ACCOUNT, container)
+        else:
+            path = '/{}/objects/batch'.format(container)
+    body = {'operation': record['operation'],
+            'objects': [{'oid': oid, 'size': size}
+                        for oid, size in record['objects']]}
+    if record.get('transfers'):
+        body['transfers'] = record['transfers']
+    return path, json.dumps(body), headers
+
+
+def replay(url, records, speedup, concurrency):
+    """Replay records and return a list of (operation, latency, status)."""
+    session = requests.Session()
+    results = []
+    lock = threading.Lock()
+
+    def send(record):
+        path, body, headers = request(record)
+        t = time.time()
+        try:
+            status = session.post(url + path, data=body,
+                                  headers=headers).status_code
+        except requests.RequestException:
+            status = 'error'
+        with lock:
+            results.append((record['operation'], time.time() - t, status))
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for record in records:
+            delay = ((record['time'] - records[0]['time']) / speedup -
+                     (time.time() - start))
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, record)
+    return results, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('capture', help='file written with CAPTURE_FILE')
+    parser.add_argument('--speedup', type=float, default=1,
+                        help='replay this many times faster than captured')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='maximum number of concurrent requests')
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='latency of the swift stand-in in seconds')
+    parser.add_argument('--asgi', action='store_true',
+                        help='replay against the ASGI app (needs uvicorn)')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='server setting, e.g. BATCH_WORKERS=16')
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    records = load(args.capture)
+    if not records:
+        parser.error('no records in ' + args.capture)
+    swift = FakeSwift(latency=args.latency, users={USER: PASSWORD})
+    populate(swift, records)
+    app.config['AUTH_URL'] = swift.auth_url
+    app.config['BASE_URL'] = swift.url
+    for setting in args.set:
+        key, value = setting.split('=', 1)
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        app.config[key] = value
+
+    with swift, (ASGIServer() if args.asgi else Server()) as server:
+        results, duration = replay(
+            server.url, records, args.speedup, args.concurrency)
+
+    print('{} requests in {:.1f}s, speedup {}, concurrency {}, {}'.format(
+        len(results), duration, args.speedup, args.concurrency,
+        ', '.join(args.set) or 'default settings'))
+    print('{:<9} {:>7} {:>9} {:>9} {:>9} {:>9} {:>7}  {}'.format(
+        'operation', 'count', 'p50 [ms]', 'p90 [ms]', 'p99 [ms]',
+        'max [ms]', 'errors', 'status codes'))
+    by_operation = defaultdict(list)
+    for operation, latency, status in results:
+        by_operation[operation].append((latency, status))
+    for operation, values in sorted(by_operation.items()):
+        latencies = [v[0] for v in values]
+        statuses = Counter(str(v[1]) for v in values)
+        errors = sum(n for s, n in statuses.items() if s != '200')
+        print('{:<9} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>6.1f}%  '
+              '{}'.format(
+                  operation, len(values), percentile(latencies, 50) * 1000,
+                  percentile(latencies, 90) * 1000,
+                  percentile(latencies, 99) * 1000, max(latencies) * 1000,
+                  100.0 * errors / len(values),
+                  ' '.join('{}:{}'.format(s, n)
+                           for s, n in sorted(statuses.items()))))
+    print('peak rss {:.1f} MiB'.format(peak_rss()))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,4 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .server import app
+
+def __getattr__(name):
+    # The app is imported lazily, so that the command line can patch the
+    # standard library for gevent before the server is imported.
+    if name == 'app':
+        from .server import app
+        return app
+    raise AttributeError(
+        'module {!r} has no attribute {!r}'.format(__name__, name))
@@ -0,0 +1,520 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""asyncio implementation of the batch API as ASGI application.
+
+It serves the same routes with the same responses as the Flask app in
+server.py and shares its configuration and caches, but multiplexes all
+batches and swift requests of a process on a single event loop. Run it
+with any ASGI server, e.g.:
+
+    uvicorn git_lfs_swift_server.asgi:app
+
+httpx is required.
+"""
+
+import asyncio
+import json
+import logging
+import random
+import re
+import string
+import time
+import weakref
+
+from werkzeug.datastructures import Authorization
+from werkzeug.exceptions import (
+    abort, HTTPException, InternalServerError, MethodNotAllowed, NotFound,
+    ServiceUnavailable, UnsupportedMediaType)
+
+from . import metrics, server, tracing
+from .server import app as flask_app, timed
+from .scheduler import AsyncFairScheduler
+from .swift import AsyncSessionPool, EndpointUnavailable, httpx
+
+logger = logging.getLogger(__name__)
+
+ROUTES = [re.compile(r) for r in (
+    r'^/(?P<account>[^/]+)/(?P<container>[^/]+)/read_(?P<readsig>[^/]+)/'
+    r'write_(?P<writesig>[^/]+)/(?P<expires_at>[^/]+)/objects/batch$',
+    r'^/(?P<account>[^/]+)/(?P<container>[^/]+)/objects/batch$',
+    r'^/(?P<container>[^/]+)/objects/batch$')]
+
+_pools = weakref.WeakKeyDictionary()
+_heads = weakref.WeakKeyDictionary()
+_schedulers = weakref.WeakKeyDictionary()
+
+
+def _get_pool():
+    """Return the pool of swift clients of the running event loop."""
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        pool = _pools[loop] = AsyncSessionPool(**server.pool_options())
+    return pool
+
+
+async def swift_request(method, url, **kwargs):
+    """Send a request to swift through the pool of the event loop.
+
+    See server.swift_request.
+    """
+    proxies = server.get_proxies()
+    if proxies is not None:
+        url = proxies.route(url)
+    start = time.perf_counter() if (
+        server.metrics_enabled() or proxies is not None or
+        tracing.current() is not None) else None
+    try:
+        r = await _get_pool().request(method, url, **kwargs)
+    except EndpointUnavailable as e:
+        server.observe_swift(method, 'unavailable', start, url, proxies)
+        logger.warning('Not sending %s to url %s. %s', method, url, str(e))
+        raise ServiceUnavailable(retry_after=e.retry_after)
+    except httpx.TransportError as e:
+        server.observe_swift(method, 'error', start, url, proxies)
+        logger.exception(
+            'Failure while sending %s to url %s. %s', method, url, str(e))
+        abort(500)
+    server.observe_swift(method, r.status_code, start, url, proxies)
+    return r
+
+
+async def head_object(url, headers):
+    """Send a HEAD request for the object at url to swift.
+
+    See server.head_object.
+    """
+    inflight = _heads.setdefault(asyncio.get_running_loop(), {})
+    key = (url, headers.get('x-auth-token'))
+    task = inflight.get(key)
+    if task is None:
+        task = inflight[key] = asyncio.ensure_future(
+            swift_request('HEAD', url, headers=headers))
+        task.add_done_callback(lambda t: inflight.pop(key, None))
+    else:
+        server.heads.shared += 1
+    return await asyncio.shield(task)
+
+
+def _get_scheduler():
+    """Return the scheduler for checks of the running event loop."""
+    loop = asyncio.get_running_loop()
+    scheduler = _schedulers.get(loop)
+    if scheduler is None:
+        scheduler = _schedulers[loop] = AsyncFairScheduler(
+            **server.scheduler_options())
+        server.schedulers.add(scheduler)
+    return scheduler
+
+
+async def run_checks(handle, c_url, headers, jobs, tenant=None):
+    """Await handle for every (oid, o_size, o_data, query) job.
+
+    The results are returned in the order of jobs. If BATCH_WORKERS is
+    greater than one, up to that many checks of all batches run
+    concurrently, shared fairly between tenants. An abort raised by any
+    check is re-raised in job order.
+    """
+    workers = flask_app.config.get('BATCH_WORKERS', 1)
+    if workers <= 1 or len(jobs) <= 1:
+        return [await handle(c_url, oid, query, headers, o_size, o_data)
+                for oid, o_size, o_data, query in jobs]
+
+    scheduler = _get_scheduler()
+    tasks = [asyncio.ensure_future(scheduler.run(
+        tenant, handle, c_url, oid, query, headers, o_size, o_data))
+        for oid, o_size, o_data, query in jobs]
+    try:
+        return [await t for t in tasks]
+    finally:
+        # Don't waste swift requests if the batch has been aborted.
+        for t in tasks:
+            t.cancel()
+
+
+async def drive(steps, func):
+    """Run the generator steps, awaiting func(*request) per request.
+
+    See server.drive.
+    """
+    try:
+        request = next(steps)
+        while True:
+            request = steps.send(await func(*request))
+    except StopIteration as e:
+        return e.value
+
+
+async def list_sizes(c_url, headers, oids):
+    """Look up the sizes of oids in the container listing.
+
+    See server.listing_pages.
+    """
+    async def get(params):
+        r = await swift_request('GET', c_url, headers=headers, params=params)
+        r.raise_for_status()
+        return r.json()
+
+    return await drive(server.listing_pages(oids), get)
+
+
+async def check_listing(operation, c_url, headers, jobs):
+    """Resolve jobs from the container listing if possible.
+
+    See server.check_listing.
+    """
+    try:
+        with timed('listing'):
+            sizes, covered = await list_sizes(
+                c_url, headers, [j[0] for j in jobs])
+    except (httpx.HTTPStatusError, ValueError) as e:
+        response = getattr(e, 'response', None)
+        if response is not None and response.status_code == 401:
+            abort(401)
+        logger.info('Listing container %s failed, falling back to per-'
+                    'object checks. %s', c_url, str(e))
+        return {}
+
+    return server.resolve_listing(operation, c_url, jobs, sizes, covered)
+
+
+async def check_jobs(
+        operation, handle, c_url, headers, token, jobs, tenant=None):
+    """Return the results of handle for all jobs, in order."""
+    resolved = server.check_cache(operation, c_url, jobs)
+    threshold = flask_app.config.get('BATCH_LISTING_THRESHOLD', 0)
+    if token and threshold and len(jobs) - len(resolved) > threshold:
+        unresolved = [i for i in range(len(jobs)) if i not in resolved]
+        listed = await check_listing(
+            operation, c_url, headers, [jobs[i] for i in unresolved])
+        for i, result in listed.items():
+            resolved[unresolved[i]] = result
+    pending = [j for i, j in enumerate(jobs) if i not in resolved]
+    unique, index = server.coalesce(pending)
+    checked = iter(server.fan_out(
+        pending, unique, index,
+        await run_checks(handle, c_url, headers, unique, tenant)))
+    return [resolved[i] if i in resolved else next(checked)
+            for i in range(len(jobs))]
+
+
+async def check_shards(batch, check, jobs):
+    """Return the results of check(c_url, jobs) for the jobs of batch.
+
+    See server.shard_checks.
+    """
+    return await drive(server.shard_checks(batch, jobs), check)
+
+
+async def handle_dl(c_url, oid, query, headers, o_size, o_data):
+    """Handle download of object by manipulating o_data dict."""
+    url = c_url + '/' + oid + query
+    success = False
+    r = await head_object(url, headers)
+    try:
+        r.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        if r.status_code == 404:
+            o_data['error'] = dict(code=404, message='Not found.')
+        elif r.status_code in (401, 403):
+            abort(r.status_code)
+        else:
+            logger.exception(
+                'Failure while heading object with url %s. %s',
+                url, str(e))
+            abort(500)
+    else:
+        size = int(r.headers['content-length'])
+        if 'x-object-manifest' not in r.headers:
+            # See server.handle_dl.
+            server.cache_object(c_url, oid, size)
+        if size != o_size:
+            o_data['error'] = dict(
+                code=422, message='Size does not match.')
+        else:
+            success = True
+
+    return success
+
+
+async def probe_write(c_url, headers):
+    """Return whether objects can be written to the container at c_url.
+
+    See server.probe_write.
+    """
+    chars = string.ascii_lowercase + string.digits
+    obj = '_'.join(random.choice(chars) for x in range(32))
+    url = c_url + '/' + obj
+    with timed('probe'):
+        r = await swift_request('POST', url, headers=headers)
+    try:
+        r.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        if r.status_code == 404:
+            pass
+        elif r.status_code == 403:
+            return False
+        else:
+            logger.exception(
+                'Failure while posting dummy object with url '
+                '%s. %s',
+                url, str(e))
+            abort(500)
+
+    return True
+
+
+async def can_write(c_url, query, headers, probes):
+    """Return whether a write ACL exists for the container at c_url.
+
+    probes is a dict of the probe tasks of the batch, see server.can_write.
+    """
+    key = (c_url, headers.get('x-auth-token'), query)
+
+    async def load():
+        writable = server.probe_cache.get(key)
+        if writable is None:
+            writable = await probe_write(c_url, headers)
+            server.probe_cache.set(
+                key, writable,
+                ttl=flask_app.config.get('WRITE_PROBE_TTL', 0))
+        return writable
+
+    if key not in probes:
+        probes[key] = asyncio.ensure_future(load())
+    return await asyncio.shield(probes[key])
+
+
+async def copy_known(c_url, oid, headers, o_size):
+    """Copy oid from a DEDUP_CONTAINERS container to c_url, if it's there.
+
+    See server.copy_known.
+    """
+    connect, read = server.copy_timeout()
+    for url, copy_headers in server.dedup_sources(c_url, oid):
+        try:
+            r = await head_object(url, headers)
+        except HTTPException as e:
+            logger.warning('Heading %s failed. %s', url, str(e))
+            return False
+        if (r.status_code != 200 or
+                int(r.headers['content-length']) != o_size):
+            continue
+        try:
+            with timed('copy'):
+                r = await swift_request(
+                    'PUT', c_url + '/' + oid,
+                    headers=dict(headers, **copy_headers),
+                    timeout=httpx.Timeout(read, connect=connect))
+            r.raise_for_status()
+        except (HTTPException, httpx.HTTPStatusError) as e:
+            logger.warning('Copying %s to %s failed. %s', url, c_url, str(e))
+            server.observe_copy(c_url, oid, o_size, False)
+            return False
+        server.observe_copy(c_url, oid, o_size, True)
+        return True
+    return False
+
+
+async def handle_ul(
+        c_url, oid, query, headers, o_size, o_data, probes=None):
+    """Handle upload of object by manipulating o_data dict."""
+    url = c_url + '/' + oid + query
+    r = await head_object(url, headers)
+    try:
+        r.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        if r.status_code == 404:
+            # Server-side copies need token auth.
+            if not query and await copy_known(c_url, oid, headers, o_size):
+                return None
+        elif r.status_code == 401:
+            abort(401)
+        elif r.status_code == 403:
+            # It's possible that a write ACL exist.
+            if not await can_write(
+                    c_url, query, headers, {} if probes is None else probes):
+                abort(403)
+        else:
+            logger.exception(
+                'Failure while heading object with url %s. %s',
+                url, str(e))
+            abort(500)
+
+        return True
+
+    if (flask_app.config.get('OBJECT_CACHE_TTL', 0) and
+            'x-object-manifest' not in r.headers):
+        server.cache_object(c_url, oid, int(r.headers['content-length']))
+
+
+def get_json(headers, body):
+    """Decode the JSON body of a request like flask.Request.get_json."""
+    mimetype = headers.get('content-type', '').split(';')[0].strip()
+    if not (mimetype == 'application/json' or
+            (mimetype.startswith('application/') and
+             mimetype.endswith('+json'))):
+        raise UnsupportedMediaType(
+            'Did not attempt to load JSON data because the request '
+            'Content-Type was not \'application/json\'.')
+    try:
+        return json.loads(body)
+    except ValueError:
+        abort(400)
+
+
+async def batch_api(
+        headers, body, account=None, container=None, readsig=None,
+        writesig=None, expires_at=None):
+    """
+    asyncio implementation of
+    https://github.com/git-lfs/git-lfs/blob/master/docs/api/batch.md.
+
+    Returns the body of the response.
+    """
+    auth = Authorization.from_header(headers.get('authorization'))
+    # The auth request is blocking.
+    with timed('auth'):
+        storage_url, token, cache_key, signer, expires_at = \
+            await asyncio.get_running_loop().run_in_executor(
+                None, server.authenticate, auth, account, container,
+                expires_at)
+
+    with timed('parse'):
+        data = get_json(headers, body)
+        logger.debug('Received Data: %s', data)
+
+        batch = server.Batch(data, storage_url, container, token, signer,
+                             readsig, writesig, expires_at)
+    server.observe_request(batch)
+    server.capture(data, server.route_type(account, readsig), container)
+
+    if batch.operation == 'download':
+        handle = handle_dl
+    else:
+        probes = {}
+
+        async def handle(*args):
+            # Probe write permissions only once per batch.
+            return await handle_ul(*args, probes=probes)
+
+    try:
+        with timed('check'):
+            results = await check_shards(
+                batch, lambda c_url, jobs: check_jobs(
+                    batch.operation, handle, c_url, batch.headers, token,
+                    jobs, batch.tenant), batch.jobs)
+    except HTTPException as e:
+        if e.code == 401 and cache_key:
+            # The cached token might have been revoked or expired.
+            server.auth_cache.invalidate(cache_key)
+        raise
+    if batch.invalid:
+        abort(400)
+
+    with timed('serialize'):
+        result = batch.result(results)
+        body = json.dumps(result)
+
+    logger.debug('Response %s', result)
+    return body
+
+
+async def _read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            pool = _pools.pop(asyncio.get_running_loop(), None)
+            if pool is not None:
+                await pool.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """The ASGI application."""
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1')
+               for k, v in scope['headers']}
+    start = time.perf_counter() if server.metrics_enabled() else None
+    match = None
+    trace = None
+    try:
+        if scope['path'] == '/metrics' and start is not None:
+            return await _metrics(scope, send)
+        for route in ROUTES:
+            match = route.match(scope['path'])
+            if match:
+                break
+        else:
+            raise NotFound()
+        if scope['method'] != 'POST':
+            raise MethodNotAllowed(valid_methods=['POST'])
+
+        trace = server.begin_trace()
+        body = await _read_body(receive)
+        status = 200
+        body = (await batch_api(headers, body, **match.groupdict())).encode()
+        response_headers = [('Content-Type', 'application/json')]
+    except HTTPException as e:
+        status = e.code
+        body = e.get_body().encode()
+        response_headers = e.get_headers()
+    except Exception:
+        logger.exception('Exception on %s [%s]', scope['path'],
+                         scope['method'])
+        e = InternalServerError()
+        status = e.code
+        body = e.get_body().encode()
+        response_headers = e.get_headers()
+
+    if match and start is not None:
+        server.BATCH_SECONDS.observe(
+            time.perf_counter() - start, (str(status),))
+    server.end_trace(trace, status)
+    await _respond(send, status, response_headers, body)
+
+
+async def _metrics(scope, send):
+    if scope['method'] not in ('GET', 'HEAD'):
+        raise MethodNotAllowed(valid_methods=['GET', 'HEAD'])
+    body = server.registry.render().encode()
+    await _respond(
+        send, 200, [('Content-Type', metrics.CONTENT_TYPE)], body)
+
+
+async def _respond(send, status, response_headers, body):
+    response_headers.append(('Content-Length', str(len(body))))
+    await send({
+        'type': 'http.response.start', 'status': status,
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                    for k, v in response_headers]})
+    await send({'type': 'http.response.body', 'body': body})
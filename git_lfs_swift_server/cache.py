@@ -0,0 +1,163 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
+import time
+
+_MISSING = object()
+
+
+class TTLCache(object):
+    """Thread-safe LRU cache with per-entry expiry.
+
+    At most maxsize entries are kept; the least recently used entry is
+    evicted first. Entries expire ttl seconds after they have been set.
+    A ttl of None means no expiry, a ttl of 0 disables caching.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def _lookup(self, key):
+        """Return the value of key or _MISSING. Caller holds the lock."""
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            return _MISSING
+        if expires is not None and expires <= time.time():
+            del self._data[key]
+            return _MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        """Return the cached value of key, or default."""
+        with self._lock:
+            value = self._lookup(key)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=_MISSING):
+        """Cache value for key, overriding the default ttl if given."""
+        ttl = self.ttl if ttl is _MISSING else ttl
+        if ttl == 0 or self.maxsize <= 0:
+            return
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        """Remove key from the cache."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def get_or_load(self, key, load, ttl=_MISSING):
+        """Return the cached value of key, or call load() and cache it.
+
+        Concurrent callers missing the same key wait for a single call
+        of load() instead of calling it themselves. Exceptions raised by
+        load() are propagated and nothing is cached.
+        """
+        with self._lock:
+            value = self._lookup(key)
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+            lock = self._loading.setdefault(key, threading.Lock())
+
+        with lock:
+            with self._lock:
+                value = self._lookup(key)
+                if value is not _MISSING:
+                    # Loaded by a concurrent caller meanwhile.
+                    self.hits += 1
+                    return value
+                self.misses += 1
+            try:
+                value = load()
+                self.set(key, value, ttl)
+            finally:
+                with self._lock:
+                    if self._loading.get(key) is lock:
+                        del self._loading[key]
+        return value
+
+    def stats(self):
+        """Return a dict with size, hits and misses of the cache."""
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits,
+                    'misses': self.misses}
+
+
+class SingleFlight(object):
+    """Share the result of concurrent calls with the same key.
+
+    While a call for a key is in flight, further calls for that key wait
+    for it and get its result or exception instead of calling again.
+    shared counts these calls.
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """Return func(), or the result of the call in flight for key."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
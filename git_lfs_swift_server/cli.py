@@ -0,0 +1,181 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Command line entry point to serve the batch API in production.
+
+The Flask app is served by gunicorn in one of three modes:
+
+* prefork: worker processes handling one request at a time
+* threaded: worker processes with a pool of threads each
+* gevent: worker processes with a green thread per request, which suits
+  the I/O-bound fan-out of HEAD requests to swift best (requires gevent)
+
+The development mode runs Flask's development server instead. Run e.g.:
+
+    git-lfs-swift-server --settings /path/to/file.py --mode gevent \
+        --bind 0.0.0.0:8080 --workers 4
+
+gunicorn restarts the workers gracefully on SIGHUP. The master process
+never imports the app, so that the new workers read the settings file
+again, and so that gevent can patch the standard library first.
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+from urllib.parse import urlsplit
+
+MODES = ('prefork', 'threaded', 'gevent', 'development')
+WORKER_CLASSES = {'prefork': 'sync', 'threaded': 'gthread',
+                  'gevent': 'gevent'}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='git-lfs-swift-server',
+        description='Serve the git lfs batch API for swift.')
+    parser.add_argument(
+        '--settings', default=os.environ.get('GIT_LFS_SWIFT_SETTINGS_FILE'),
+        help='settings file (default: $GIT_LFS_SWIFT_SETTINGS_FILE)')
+    parser.add_argument('--mode', choices=MODES, default='threaded',
+                        help='serving mode (default: threaded)')
+    parser.add_argument('--bind', default='127.0.0.1:5000',
+                        help='address to listen on (default: %(default)s)')
+    parser.add_argument(
+        '--workers', type=int, default=multiprocessing.cpu_count() * 2 + 1,
+        help='number of worker processes (default: 2 * CPUs + 1)')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='threads per worker in threaded mode')
+    parser.add_argument(
+        '--connections', type=int, default=1000,
+        help='concurrent connections per worker in gevent mode')
+    parser.add_argument(
+        '--keepalive', type=int, default=5,
+        help='seconds to keep idle client connections open (not in '
+             'prefork mode)')
+    parser.add_argument('--timeout', type=int, default=120,
+                        help='seconds after which silent workers are '
+                             'restarted')
+    parser.add_argument(
+        '--graceful-timeout', type=int, default=30,
+        help='seconds workers may finish their requests on restart')
+    parser.add_argument('--max-requests', type=int, default=0,
+                        help='restart workers after that many requests')
+    parser.add_argument('--pid', help='file to write the pid to, e.g. to '
+                                      'reload with kill -HUP')
+    args = parser.parse_args(argv)
+    for name in 'workers', 'threads', 'connections':
+        if getattr(args, name) < 1:
+            parser.error('--{} must be at least 1.'.format(name))
+    return parser, args
+
+
+def load_config():
+    """Return the settings of the app, without importing it."""
+    from flask import Config
+
+    config = Config(os.getcwd())
+    config.from_envvar('GIT_LFS_SWIFT_SETTINGS_FILE', silent=True)
+    for key in 'AUTH_URL', 'BASE_URL':
+        if 'GIT_LFS_SWIFT_' + key in os.environ:
+            config[key] = os.environ['GIT_LFS_SWIFT_' + key]
+    return config
+
+
+def validate(config):
+    """Return an error message if config can't serve batches, or None."""
+    if not config.get('AUTH_URL') and not config.get('BASE_URL'):
+        return 'AUTH_URL or BASE_URL must be specified.'
+    for key in 'AUTH_URL', 'BASE_URL':
+        if config.get(key):
+            parts = urlsplit(config[key])
+            if parts.scheme not in ('http', 'https') or not parts.netloc:
+                return '{} must be an http(s) URL, not {!r}.'.format(
+                    key, config[key])
+    return None
+
+
+def gunicorn_options(args):
+    """Return the gunicorn settings of args."""
+    options = {
+        'bind': args.bind, 'workers': args.workers,
+        'worker_class': WORKER_CLASSES[args.mode],
+        'keepalive': args.keepalive, 'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'max_requests': args.max_requests,
+        # Every worker imports the app after forking, so that connections
+        # and threads are not shared between processes, and a reload
+        # reads the settings file again.
+        'preload_app': False}
+    if args.mode == 'threaded':
+        options['threads'] = args.threads
+    elif args.mode == 'gevent':
+        options['worker_connections'] = args.connections
+    if args.pid:
+        options['pidfile'] = args.pid
+    return options
+
+
+def serve(options):
+    """Serve the app with gunicorn and the given settings."""
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from .server import app
+            return app
+
+    Application().run()
+
+
+def main(argv=None):
+    parser, args = parse_args(argv)
+    if args.settings:
+        os.environ['GIT_LFS_SWIFT_SETTINGS_FILE'] = os.path.abspath(
+            args.settings)
+
+    if args.mode == 'gevent':
+        try:
+            from gevent import monkey
+        except ImportError:
+            parser.error('gevent is required for gevent mode.')
+        monkey.patch_all()
+    if args.mode != 'development':
+        try:
+            import gunicorn  # noqa: F401
+        except ImportError:
+            parser.error('gunicorn is required for {} mode.'.format(
+                args.mode))
+
+    error = validate(load_config())
+    if error:
+        parser.error(error)
+
+    if args.mode == 'development':
+        from .server import app
+        host, _, port = args.bind.rpartition(':')
+        app.run(host=host or None, port=int(port), threaded=True)
+    else:
+        serve(gunicorn_options(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
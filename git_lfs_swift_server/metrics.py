@@ -0,0 +1,220 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Minimal metrics in the Prometheus text exposition format."""
+
+import contextlib
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds.
+DURATION_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+    30, 60)
+# Objects per batch.
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+# Returned instead of a timer if metrics are disabled.
+NOOP = contextlib.nullcontext()
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric(object):
+    """Base class of metrics with a fixed set of label names."""
+
+    kind = None
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _check(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError('{} expects labels {}, got {}'.format(
+                self.name, self.labelnames, labels))
+
+    def samples(self):
+        """Return a list of (suffix, labels, extra labels, value)."""
+        raise NotImplementedError
+
+    def render(self):
+        """Return the metric in the text exposition format."""
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, labels, extra, value in self.samples():
+            lines.append('{}{}{} {}'.format(
+                self.name, suffix, _labels(self.labelnames, labels, extra),
+                _number(value)))
+        return '\n'.join(lines)
+
+    def clear(self):
+        """Reset all values."""
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    """A monotonically increasing value per label combination."""
+
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        """Increase the value of labels by amount."""
+        self._check(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        """Return the current value of labels."""
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            return [('', labels, (), value)
+                    for labels, value in sorted(self._values.items())]
+
+
+class _Timer(object):
+
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+
+
+class Histogram(Metric):
+    """Counts of observed values in cumulative buckets, with their sum."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=DURATION_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, labels=()):
+        """Add value to the histogram of labels."""
+        self._check(labels)
+        with self._lock:
+            data = self._values.get(labels)
+            if data is None:
+                # Bucket counts followed by the sum.
+                data = self._values[labels] = [0] * len(self.buckets) + [0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            data[-1] += value
+
+    def time(self, labels=()):
+        """Return a context manager observing its duration in seconds."""
+        return _Timer(self, labels)
+
+    def count(self, labels=()):
+        """Return the number of observations of labels."""
+        with self._lock:
+            return sum(self._values.get(labels, [0])[:-1])
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for labels, data in sorted(self._values.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, data):
+                    cumulative += n
+                    result.append(
+                        ('_bucket', labels, (('le', _number(bound)),),
+                         cumulative))
+                result.append(('_sum', labels, (), data[-1]))
+                result.append(('_count', labels, (), cumulative))
+        return result
+
+
+class Collected(Metric):
+    """A metric whose values are returned by a function when rendered.
+
+    func returns a list of (labels, value) tuples.
+    """
+
+    def __init__(self, name, doc, kind, func, labelnames=()):
+        super(Collected, self).__init__(name, doc, labelnames)
+        self.kind = kind
+        self.func = func
+
+    def samples(self):
+        return [('', labels, (), value) for labels, value in self.func()]
+
+
+class Registry(object):
+    """A set of metrics, rendered together."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        """Add metric to the registry and return it."""
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, doc, labelnames=()):
+        return self.register(Counter(name, doc, labelnames))
+
+    def histogram(self, name, doc, labelnames=(), buckets=DURATION_BUCKETS):
+        return self.register(Histogram(name, doc, labelnames, buckets))
+
+    def collected(self, name, doc, kind, func, labelnames=()):
+        return self.register(Collected(name, doc, kind, func, labelnames))
+
+    def render(self):
+        """Return all metrics in the text exposition format."""
+        return '\n'.join(m.render() for m in self._metrics) + '\n'
+
+    def clear(self):
+        """Reset the values of all metrics."""
+        for metric in self._metrics:
+            metric.clear()
@@ -0,0 +1,264 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Weighted fair scheduling of work across tenants.
+
+Work is queued per tenant (e.g. account and container), and the tenant
+which has received the smallest share of the workers relative to its
+weight is served next (stride scheduling). A tenant submitting
+thousands of jobs therefore delays the few jobs of another tenant by
+at most a job per worker, instead of by all of its own jobs.
+"""
+
+import asyncio
+from collections import deque
+from concurrent.futures import Future
+import threading
+import time
+
+
+class WeightError(Exception):
+    """The weight of a tenant could not be determined.
+
+    The item has been dequeued nevertheless and counts as running, see
+    FairQueue.get. The original exception is the __cause__.
+    """
+
+    def __init__(self, tenant, item):
+        super(WeightError, self).__init__(
+            'Invalid weight of tenant {}.'.format(tenant))
+        self.tenant = tenant
+        self.item = item
+
+
+class FairQueue(object):
+    """Per-tenant queues, which are dequeued in weighted fair order.
+
+    weight is called with a tenant and returns its weight, a positive
+    number. Every item dequeued advances the pass of its tenant by one
+    divided by its weight, and the eligible tenant with the lowest pass
+    is dequeued next. Tenants becoming active start at the pass of the
+    last dequeued item, so idle tenants don't accumulate credit. A tenant
+    is eligible if it has queued items and, if max_running is set, less
+    than max_running items are running. The queue is not thread-safe.
+    """
+
+    def __init__(self, weight=None, max_running=0):
+        self.weight = weight or (lambda tenant: 1)
+        self.max_running = max_running
+        self.queues = {}
+        self.running = {}
+        self._pass = {}
+        self._vtime = 0.0
+
+    def __len__(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def put(self, tenant, item):
+        """Queue item for tenant."""
+        queue = self.queues.get(tenant)
+        if queue is None:
+            queue = self.queues[tenant] = deque()
+            self._pass[tenant] = max(self._pass.get(tenant, 0), self._vtime)
+        queue.append((time.perf_counter(), item))
+
+    def get(self):
+        """Return (tenant, item, seconds queued) of the next item.
+
+        Returns None if no tenant is eligible. The item counts as running
+        until done is called with its tenant. If weight fails or returns
+        no positive number, WeightError is raised with the item.
+        """
+        tenant = None
+        for t in self.queues:
+            if (self.max_running and
+                    self.running.get(t, 0) >= self.max_running):
+                continue
+            if tenant is None or self._pass[t] < self._pass[tenant]:
+                tenant = t
+        if tenant is None:
+            return None
+
+        queue = self.queues[tenant]
+        queued, item = queue.popleft()
+        if not queue:
+            del self.queues[tenant]
+        self.running[tenant] = self.running.get(tenant, 0) + 1
+        self._vtime = self._pass[tenant]
+        try:
+            step = 1.0 / self.weight(tenant)
+            if not step > 0:
+                raise ValueError('Weight is not positive.')
+        except Exception as e:
+            self._pass[tenant] += 1.0
+            raise WeightError(tenant, item) from e
+        self._pass[tenant] += step
+        return tenant, item, time.perf_counter() - queued
+
+    def done(self, tenant):
+        """Record that an item of tenant has finished."""
+        self.running[tenant] -= 1
+        if not self.running[tenant]:
+            del self.running[tenant]
+            if tenant not in self.queues:
+                del self._pass[tenant]
+
+    def depths(self):
+        """Return a dict mapping tenants to their number of queued items."""
+        return dict((t, len(q)) for t, q in self.queues.items())
+
+
+class FairScheduler(object):
+    """A thread pool running the jobs of tenants in weighted fair order.
+
+    See FairQueue for weight and max_running. observe is called with
+    the tenant and the seconds a job has been queued, when it starts.
+    """
+
+    def __init__(self, workers, weight=None, max_running=0, observe=None):
+        self.workers = workers
+        self.observe = observe
+        self._queue = FairQueue(weight, max_running)
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def submit(self, tenant, func, *args):
+        """Queue func(*args) for tenant and return a Future of its result.
+
+        Cancelling the future before the job is started skips the job.
+        """
+        future = Future()
+        with self._cond:
+            self._queue.put(tenant, (future, func, args))
+            self._threads = [t for t in self._threads if t.is_alive()]
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._work, name='git-lfs-swift-scheduler')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify()
+        return future
+
+    def _get(self):
+        """Return the next job, failing those of invalid tenants."""
+        while True:
+            with self._cond:
+                try:
+                    job = self._queue.get()
+                    while job is None:
+                        self._cond.wait()
+                        job = self._queue.get()
+                    return job
+                except WeightError as e:
+                    self._queue.done(e.tenant)
+                    error = e
+            future = error.item[0]
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
+
+    def _work(self):
+        while True:
+            tenant, (future, func, args), queued = self._get()
+            try:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    if self.observe is not None:
+                        self.observe(tenant, queued)
+                    result = func(*args)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            finally:
+                with self._cond:
+                    self._queue.done(tenant)
+                    # A job of a capped tenant might be eligible now.
+                    self._cond.notify()
+
+    def depths(self):
+        """Return a dict mapping tenants to their number of queued jobs."""
+        with self._cond:
+            return self._queue.depths()
+
+    def running(self):
+        """Return a dict mapping tenants to their number of running jobs."""
+        with self._cond:
+            return dict(self._queue.running)
+
+
+class AsyncFairScheduler(object):
+    """asyncio counterpart of FairScheduler.
+
+    At most workers coroutines run at the same time, see FairScheduler.
+    """
+
+    def __init__(self, workers, weight=None, max_running=0, observe=None):
+        self.workers = workers
+        self.observe = observe
+        self._queue = FairQueue(weight, max_running)
+        self._active = 0
+
+    def _dispatch(self):
+        while self._active < self.workers:
+            try:
+                job = self._queue.get()
+            except WeightError as e:
+                self._queue.done(e.tenant)
+                if not e.item.cancelled():
+                    e.item.set_exception(e)
+                continue
+            if job is None:
+                return
+            tenant, waiter, queued = job
+            if waiter.cancelled():
+                self._queue.done(tenant)
+                continue
+            self._active += 1
+            waiter.set_result(queued)
+
+    async def run(self, tenant, func, *args):
+        """Await func(*args) for tenant, once it is its turn."""
+        waiter = asyncio.get_running_loop().create_future()
+        self._queue.put(tenant, waiter)
+        self._dispatch()
+        try:
+            queued = await waiter
+        except asyncio.CancelledError:
+            if (waiter.done() and not waiter.cancelled() and
+                    waiter.exception() is None):
+                # Cancelled after being dispatched.
+                self._release(tenant)
+            raise
+        try:
+            if self.observe is not None:
+                self.observe(tenant, queued)
+            return await func(*args)
+        finally:
+            self._release(tenant)
+
+    def _release(self, tenant):
+        self._active -= 1
+        self._queue.done(tenant)
+        self._dispatch()
+
+    def depths(self):
+        """Return a dict mapping tenants to their number of queued jobs."""
+        return self._queue.depths()
+
+    def running(self):
+        """Return a dict mapping tenants to their number of running jobs."""
+        return dict(self._queue.running)
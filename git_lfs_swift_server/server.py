@@ -13,20 +13,48 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextvars
 from datetime import datetime
+import functools
+import hashlib
 import json
 import logging
+import math
 import os
 import random
 import string
+import sys
+import threading
 import time
+from urllib.parse import urlsplit
+import weakref
+import zlib
 
 import pytz
 import requests
 from swiftclient import client
 from swiftclient.exceptions import ClientException
 
-from flask import abort, Flask, request
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+from flask import abort, Flask, request, Response
+from werkzeug.exceptions import HTTPException, ServiceUnavailable
+
+from . import metrics, tempurl, tracing
+from .cache import SingleFlight, TTLCache
+from .scheduler import FairScheduler
+from .swift import EndpointUnavailable, ProxyPool, SessionPool
 
 app = Flask(__name__)
 app.config.from_envvar('GIT_LFS_SWIFT_SETTINGS_FILE', silent=True)
@@ -48,13 +76,558 @@ if app.config.get('LOGFILE') or app.config.get('LOGLEVEL'):
         format='%(asctime)s [%(name)s] %(levelname)s %(message)s')
 
 logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger(__name__ + '.trace')
+
+# Segments of static large objects are uploaded below this prefix.
+SEGMENT_PREFIX = '.segments/'
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+_pool = None
+_pool_lock = threading.Lock()
+_proxies = None
+_proxies_lock = threading.Lock()
+_signers = {}
+_signers_lock = threading.Lock()
+_trace_lock = threading.Lock()
+_capture_lock = threading.Lock()
+
+auth_cache = TTLCache(maxsize=app.config.get('AUTH_CACHE_SIZE', 1024))
+object_cache = TTLCache(maxsize=app.config.get('OBJECT_CACHE_SIZE', 100000))
+probe_cache = TTLCache(maxsize=app.config.get('WRITE_PROBE_CACHE_SIZE', 1024))
+heads = SingleFlight()
+
+registry = metrics.Registry()
+PHASE_SECONDS = registry.histogram(
+    'git_lfs_swift_phase_seconds',
+    'Duration of the phases of batch requests.', ('phase',))
+BATCH_SECONDS = registry.histogram(
+    'git_lfs_swift_batch_seconds',
+    'Duration of batch requests until the response is started.',
+    ('status',))
+BATCHES = registry.counter(
+    'git_lfs_swift_batches_total', 'Valid batch requests.',
+    ('operation', 'transfer'))
+BATCH_OBJECTS = registry.histogram(
+    'git_lfs_swift_batch_objects', 'Number of objects per batch.',
+    ('operation',), buckets=metrics.SIZE_BUCKETS)
+SWIFT_SECONDS = registry.histogram(
+    'git_lfs_swift_swift_request_seconds',
+    'Duration of requests to swift.', ('method',))
+SWIFT_RESPONSES = registry.counter(
+    'git_lfs_swift_swift_responses_total',
+    'Responses from swift by status code, or error if none was received.',
+    ('method', 'status'))
+COALESCED = registry.counter(
+    'git_lfs_swift_coalesced_checks_total',
+    'Checks of duplicate objects within a batch, which were not sent to '
+    'swift.')
+registry.collected(
+    'git_lfs_swift_shared_heads_total',
+    'HEAD requests shared with a concurrent request for the same object '
+    'and credentials.', 'counter', lambda: [((), heads.shared)])
+DEDUP_COPIES = registry.counter(
+    'git_lfs_swift_dedup_copies_total',
+    'Uploads replaced by server-side copies from DEDUP_CONTAINERS, by '
+    'result.', ('result',))
+SCHEDULER_WAIT = registry.histogram(
+    'git_lfs_swift_scheduler_wait_seconds',
+    'Time per-object checks are queued before a worker runs them.')
+# The schedulers of the process, see _get_scheduler.
+schedulers = weakref.WeakSet()
+registry.collected(
+    'git_lfs_swift_scheduler_queued',
+    'Per-object checks waiting for a worker, by tenant.', 'gauge',
+    lambda: [((t,), n) for s in schedulers for t, n in s.depths().items()],
+    ('tenant',))
+registry.collected(
+    'git_lfs_swift_scheduler_running',
+    'Per-object checks running, by tenant.', 'gauge',
+    lambda: [((t,), n) for s in schedulers for t, n in s.running().items()],
+    ('tenant',))
+CACHES = (('auth', auth_cache), ('object', object_cache),
+          ('probe', probe_cache))
+
+
+def _cache_stats(field):
+    return lambda: [((name,), cache.stats()[field])
+                    for name, cache in CACHES]
+
+
+registry.collected(
+    'git_lfs_swift_cache_hits_total', 'Cache hits.', 'counter',
+    _cache_stats('hits'), ('cache',))
+registry.collected(
+    'git_lfs_swift_cache_misses_total', 'Cache misses.', 'counter',
+    _cache_stats('misses'), ('cache',))
+registry.collected(
+    'git_lfs_swift_cache_entries', 'Cached entries.', 'gauge',
+    _cache_stats('size'), ('cache',))
+
+
+def metrics_enabled():
+    """Return whether METRICS_ENABLED is set."""
+    return app.config.get('METRICS_ENABLED', False)
+
+
+def timed(phase):
+    """Return a context manager recording the duration of phase.
+
+    The duration is recorded in the metrics if METRICS_ENABLED is set,
+    and as span of the current trace, if any.
+    """
+    trace = tracing.current()
+    timer = PHASE_SECONDS.time((phase,)) if metrics_enabled() else None
+    if trace is not None:
+        return trace.span(phase, timer)
+    return metrics.NOOP if timer is None else timer
+
+
+def observe_swift(method, status, start, url=None, proxies=None):
+    """Record a request to swift started at perf_counter() start.
+
+    status is the status code of the response, or a string describing
+    why there is none: 'error' for connection errors and timeouts, and
+    'unavailable' if the request has not been sent. The duration is
+    recorded in the metrics, as span of the current trace and, if given,
+    for the proxy of url in proxies. Proxies are only marked as failed by
+    errors and 5xx responses, and only the durations of HEAD and GET
+    requests are comparable enough to rank them.
+    """
+    if start is None:
+        return
+    seconds = time.perf_counter() - start
+    trace = tracing.current()
+    if trace is not None:
+        # Without the query, which may contain signatures.
+        trace.add('swift', start, seconds, method=method, status=status,
+                  url=url.split('?', 1)[0])
+    if proxies is not None and status != 'unavailable':
+        proxy = proxies.proxy(url)
+        if proxy is not None:
+            proxies.observe(
+                proxy, seconds if method in ('HEAD', 'GET') else None,
+                ok=isinstance(status, int) and status < 500)
+    if metrics_enabled():
+        SWIFT_SECONDS.observe(seconds, (method,))
+        SWIFT_RESPONSES.inc((method, str(status)))
+
+
+def pool_options():
+    """Return the keyword arguments of the swift session pools."""
+    return dict(
+        pool_size=app.config.get('SWIFT_POOL_SIZE', 10),
+        timeout=(app.config.get('SWIFT_CONNECT_TIMEOUT', 10),
+                 app.config.get('SWIFT_READ_TIMEOUT', 60)),
+        keepalive=app.config.get('SWIFT_KEEPALIVE', True),
+        retries=app.config.get('SWIFT_RETRIES', 0),
+        backoff=app.config.get('SWIFT_RETRY_BACKOFF', 0.1),
+        backoff_max=app.config.get('SWIFT_RETRY_BACKOFF_MAX', 2),
+        breaker_threshold=app.config.get('SWIFT_BREAKER_THRESHOLD', 0),
+        breaker_timeout=app.config.get('SWIFT_BREAKER_TIMEOUT', 30),
+        max_concurrency=app.config.get('SWIFT_MAX_CONCURRENCY', 0),
+        queue_timeout=app.config.get('SWIFT_QUEUE_TIMEOUT', 10))
+
+
+def _get_pool():
+    """Return the process-wide pool of swift sessions."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SessionPool(**pool_options())
+        return _pool
+
+
+def get_proxies():
+    """Return the ProxyPool of SWIFT_PROXIES, or None if not set.
+
+    Unless SWIFT_HEALTH_INTERVAL is 0, the proxies are health checked in a
+    background thread every that many seconds. Otherwise, unhealthy
+    proxies get a trial request every SWIFT_PROXY_RETRY seconds.
+    """
+    global _proxies
+    if not app.config.get('SWIFT_PROXIES'):
+        return None
+    with _proxies_lock:
+        if _proxies is None:
+            interval = app.config.get('SWIFT_HEALTH_INTERVAL', 10)
+            _proxies = ProxyPool(
+                app.config['SWIFT_PROXIES'],
+                alpha=app.config.get('SWIFT_PROXY_EWMA_ALPHA', 0.3),
+                retry=None if interval else app.config.get(
+                    'SWIFT_PROXY_RETRY', 30))
+            if interval:
+                thread = threading.Thread(
+                    target=_health_checks, args=(_proxies, interval))
+                thread.daemon = True
+                thread.start()
+        return _proxies
+
+
+def _health_checks(proxies, interval):
+    while True:
+        proxies.check(
+            lambda url, **kwargs: _get_pool().session(url).get(
+                url, **kwargs),
+            timeout=app.config.get('SWIFT_CONNECT_TIMEOUT', 10))
+        time.sleep(interval)
+
+
+def spread(url, key):
+    """Return url on the proxy for key, if SWIFT_PROXIES is set."""
+    proxies = get_proxies()
+    return url if proxies is None else proxies.route(url, key)
+
+
+def swift_request(method, url, **kwargs):
+    """Send a request to swift through the session pool.
+
+    If SWIFT_PROXIES is set, the request is sent to the fastest healthy
+    proxy. Connection errors and timeouts are logged and abort with 500.
+    If the swift endpoint is overloaded, abort with 503, so that clients
+    retry.
+    """
+    proxies = get_proxies()
+    if proxies is not None:
+        url = proxies.route(url)
+    start = time.perf_counter() if (
+        metrics_enabled() or proxies is not None or
+        tracing.current() is not None) else None
+    try:
+        r = _get_pool().request(method, url, **kwargs)
+    except EndpointUnavailable as e:
+        observe_swift(method, 'unavailable', start, url, proxies)
+        logger.warning('Not sending %s to url %s. %s', method, url, str(e))
+        raise ServiceUnavailable(retry_after=e.retry_after)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        observe_swift(method, 'error', start, url, proxies)
+        logger.exception(
+            'Failure while sending %s to url %s. %s', method, url, str(e))
+        abort(500)
+    observe_swift(method, r.status_code, start, url, proxies)
+    return r
+
+
+def tenant_weight(tenant):
+    """Return the scheduling weight of tenant '<account>/<container>'.
+
+    The weight is looked up in SCHEDULER_WEIGHTS by tenant first, then by
+    account, and defaults to 1. Invalid weights are replaced by 1, too.
+    """
+    weights = app.config.get('SCHEDULER_WEIGHTS', {})
+    weight = weights.get(tenant, weights.get(str(tenant).split('/')[0], 1))
+    return weight if valid_weight(weight) else 1
+
+
+def valid_weight(weight):
+    """Return whether weight is a positive number."""
+    return (isinstance(weight, (int, float)) and
+            not isinstance(weight, bool) and 0 < weight < float('inf'))
+
+
+def observe_wait(tenant, seconds):
+    """Record that a check of tenant has been queued for seconds."""
+    if metrics_enabled():
+        SCHEDULER_WAIT.observe(seconds)
+
+
+def scheduler_options():
+    """Return the keyword arguments of the scheduler for checks."""
+    for tenant, weight in app.config.get('SCHEDULER_WEIGHTS', {}).items():
+        if not valid_weight(weight):
+            logger.warning('Ignoring invalid scheduler weight %r of %s.',
+                           weight, tenant)
+    return dict(
+        workers=app.config.get('BATCH_WORKERS', 1), weight=tenant_weight,
+        max_running=app.config.get('SCHEDULER_MAX_RUNNING', 0),
+        observe=observe_wait)
+
+
+def _get_scheduler():
+    """Return the process-wide scheduler for per-object checks."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = FairScheduler(**scheduler_options())
+            schedulers.add(_scheduler)
+        return _scheduler
+
+
+def get_signer(account, container):
+    """Return a TempURLSigner for the container, or None.
+
+    The key is looked up in TEMPURL_KEYS by '<account>/<container>' first,
+    then by '<account>'.
+    """
+    keys = app.config.get('TEMPURL_KEYS', {})
+    key = keys.get(account + '/' + container, keys.get(account))
+    if not key:
+        return None
+    with _signers_lock:
+        if key not in _signers:
+            _signers[key] = tempurl.TempURLSigner(
+                key, cache_size=app.config.get('TEMPURL_CACHE_SIZE', 10000))
+        return _signers[key]
+
+
+def get_auth(username, password):
+    """Return (storage_url, token, cache_key) for the given credentials.
+
+    If AUTH_CACHE_TTL is set, tokens are cached for that many seconds,
+    and concurrent requests with the same credentials share a single
+    auth request. cache_key is None if the cache is disabled.
+    """
+    auth_url = app.config['AUTH_URL']
+    # With this option it should be possible
+    # to use keystone auth, too.
+    kwargs = app.config.get('AUTH_KWARGS', {})
+    ttl = app.config.get('AUTH_CACHE_TTL', 0)
+    if not ttl:
+        return client.get_auth(auth_url, username, password, **kwargs) + (
+            None,)
+
+    cache_key = (
+        auth_url, username,
+        hashlib.sha256(password.encode('utf-8')).hexdigest(),
+        json.dumps(kwargs, sort_keys=True, default=str))
+    storage_url, token = auth_cache.get_or_load(
+        cache_key,
+        lambda: client.get_auth(auth_url, username, password, **kwargs),
+        ttl=ttl)
+    return storage_url, token, cache_key
+
+
+def _submit(scheduler, tenant, func, *args):
+    """Submit func to scheduler, in a copy of the context if traced.
+
+    This way, spans of the worker threads are added to the current trace.
+    """
+    if tracing.current() is None:
+        return scheduler.submit(tenant, func, *args)
+    return scheduler.submit(
+        tenant, contextvars.copy_context().run, func, *args)
+
+
+def run_checks(handle, c_url, headers, jobs, tenant=None):
+    """Call handle for every (oid, o_size, o_data, query) job.
+
+    The results are returned in the order of jobs. If BATCH_WORKERS is
+    greater than one, the checks are executed concurrently by a pool of
+    that many threads, shared fairly between tenants, see FairScheduler.
+    An abort raised by any check is re-raised in job order, so the status
+    code of the batch is the same as in sequential mode.
+    """
+    if app.config.get('BATCH_WORKERS', 1) <= 1 or len(jobs) <= 1:
+        return [handle(c_url, oid, query, headers, o_size, o_data)
+                for oid, o_size, o_data, query in jobs]
+
+    scheduler = _get_scheduler()
+    futures = [
+        _submit(scheduler, tenant, handle, c_url, oid, query, headers,
+                o_size, o_data)
+        for oid, o_size, o_data, query in jobs]
+    try:
+        return [f.result() for f in futures]
+    finally:
+        # Don't waste swift requests if the batch has been aborted.
+        for f in futures:
+            f.cancel()
+
+
+def coalesce(jobs):
+    """Return the unique jobs by oid and size, and an index into them.
+
+    The index maps every job to the position of its unique job.
+    """
+    unique = []
+    index = []
+    positions = {}
+    for job in jobs:
+        key = job[:2]
+        if key not in positions:
+            positions[key] = len(unique)
+            unique.append(job)
+        index.append(positions[key])
+    if metrics_enabled() and len(unique) < len(jobs):
+        COALESCED.inc(amount=len(jobs) - len(unique))
+    return unique, index
+
+
+def fan_out(jobs, unique, index, results):
+    """Return the results of jobs, given the results of the unique jobs.
+
+    Errors set by the checks of the unique jobs are copied to duplicates.
+    """
+    for job, i in zip(jobs, index):
+        if job is not unique[i] and 'error' in unique[i][2]:
+            job[2]['error'] = unique[i][2]['error']
+    return [results[i] for i in index]
+
+
+def head_object(url, headers):
+    """Send a HEAD request for the object at url to swift.
+
+    Concurrent requests with the same url (including temporary URL
+    signatures) and token share a single request.
+    """
+    return heads.do(
+        (url, headers.get('x-auth-token')),
+        lambda: swift_request('HEAD', url, headers=headers))
+
+
+def _successor(name):
+    """Return a name greater than name and all names prefixed by it."""
+    return name[:-1] + chr(ord(name[-1]) + 1)
+
+
+def drive(steps, func):
+    """Run the generator steps, sending it func(*request) per request.
+
+    steps yields tuples of arguments and returns the result. This way,
+    the same logic can be driven with blocking and asyncio requests.
+    """
+    try:
+        request = next(steps)
+        while True:
+            request = steps.send(func(*request))
+    except StopIteration as e:
+        return e.value
+
+
+def listing_pages(oids):
+    """Generate the listing requests to look up the sizes of oids.
+
+    The listing is paged from the smallest to the largest oid, skipping
+    ahead to the next requested oid after every page. At most
+    BATCH_LISTING_MAX_PAGES listing requests are sent. Yields a tuple
+    with the query parameters of every page and expects the listing of
+    the page to be sent back, see drive.
+
+    Returns a dict mapping the listed oids to their sizes and a set of
+    the oids that have been covered by the listing.
+    """
+    oids = sorted(set(oids))
+    limit = app.config.get('BATCH_LISTING_LIMIT', 10000)
+    max_pages = app.config.get('BATCH_LISTING_MAX_PAGES', 10)
+    end_marker = _successor(oids[-1])
+    sizes = {}
+    i = 0
+    marker = ''
+    for _ in range(max_pages):
+        if i == len(oids):
+            break
+        marker = max(marker, oids[i][:-1])
+        listing = yield ({'format': 'json', 'limit': limit, 'marker': marker,
+                          'end_marker': end_marker},)
+        for entry in listing:
+            sizes[entry['name']] = entry['bytes']
+        if len(listing) < limit:
+            # The listing is complete up to end_marker.
+            i = len(oids)
+        else:
+            marker = listing[-1]['name']
+            while i < len(oids) and oids[i] <= marker:
+                i += 1
+
+    return sizes, set(oids[:i])
+
+
+def list_sizes(c_url, headers, oids):
+    """Look up the sizes of oids in the container listing.
+
+    See listing_pages.
+    """
+    def get(params):
+        r = swift_request('GET', c_url, headers=headers, params=params)
+        r.raise_for_status()
+        return r.json()
+
+    return drive(listing_pages(oids), get)
+
+
+def check_listing(operation, c_url, headers, jobs):
+    """Resolve jobs from the container listing if possible.
+
+    Returns a dict mapping the indices of the resolved jobs to their
+    result, see resolve_listing.
+    """
+    try:
+        with timed('listing'):
+            sizes, covered = list_sizes(
+                c_url, headers, [j[0] for j in jobs])
+    except (requests.RequestException, ValueError) as e:
+        response = getattr(e, 'response', None)
+        if response is not None and response.status_code == 401:
+            abort(401)
+        # Without listing permissions, only heading objects is possible.
+        # Malformed listings are ignored, too.
+        logger.info('Listing container %s failed, falling back to per-'
+                    'object checks. %s', c_url, str(e))
+        return {}
+
+    return resolve_listing(operation, c_url, jobs, sizes, covered)
+
+
+def resolve_listing(operation, c_url, jobs, sizes, covered):
+    """Resolve jobs from the result of list_sizes.
+
+    Returns a dict mapping the indices of the resolved jobs to their
+    result, as handle_dl or handle_ul would have returned it. Objects
+    that are not listed with the requested size are left to the per-object
+    checks, because listings are updated asynchronously and large object
+    manifests may be listed with a different size. For uploads, objects
+    missing in the listing are resolved as to be uploaded, unless they
+    might be copied from DEDUP_CONTAINERS.
+    """
+    resolved = {}
+    dedup = app.config.get('DEDUP_CONTAINERS')
+    for i, (oid, o_size, o_data, query) in enumerate(jobs):
+        if sizes.get(oid) == o_size:
+            cache_object(c_url, oid, o_size)
+            resolved[i] = True if operation == 'download' else None
+        elif (operation == 'upload' and oid in covered and
+                oid not in sizes and not dedup):
+            resolved[i] = True
+    return resolved
+
+
+def cache_object(c_url, oid, size):
+    """Remember that oid exists with size in the container at c_url."""
+    object_cache.set(
+        (c_url, oid), size, ttl=app.config.get('OBJECT_CACHE_TTL', 0))
+
+
+def check_cache(operation, c_url, jobs):
+    """Resolve jobs from the object cache.
+
+    Objects are content addressed, so a cached size never becomes wrong.
+    The first job is never resolved from the cache, so that every batch
+    makes at least one request to swift with the credentials of the user.
+    Returns a dict mapping the indices of the resolved jobs to their result.
+    """
+    resolved = {}
+    if not app.config.get('OBJECT_CACHE_TTL', 0):
+        return resolved
+
+    for i, (oid, o_size, o_data, query) in enumerate(jobs[1:], 1):
+        size = object_cache.get((c_url, oid))
+        if size is None:
+            continue
+        if operation == 'upload':
+            resolved[i] = None
+        elif size == o_size:
+            resolved[i] = True
+        else:
+            o_data['error'] = dict(code=422, message='Size does not match.')
+            resolved[i] = False
+    return resolved
 
 
 def handle_dl(c_url, oid, query, headers, o_size, o_data):
     """Handle download of object by manipulating o_data dict."""
     url = c_url + '/' + oid + query
     success = False
-    r = requests.head(url, headers=headers)
+    r = head_object(url, headers)
     try:
         r.raise_for_status()
     except requests.RequestException as e:
@@ -68,7 +641,13 @@ def handle_dl(c_url, oid, query, headers, o_size, o_data):
                 url, str(e))
             abort(500)
     else:
-        if int(r.headers['content-length']) != o_size:
+        # HEAD returns the total size of static and dynamic large objects.
+        size = int(r.headers['content-length'])
+        if 'x-object-manifest' not in r.headers:
+            # Dynamic large objects change with their segments, so only
+            # the sizes of other objects are cached.
+            cache_object(c_url, oid, size)
+        if size != o_size:
             o_data['error'] = dict(
                 code=422, message='Size does not match.')
         else:
@@ -77,42 +656,150 @@ def handle_dl(c_url, oid, query, headers, o_size, o_data):
     return success
 
 
+def probe_write(c_url, headers):
+    """Return whether objects can be written to the container at c_url.
+
+    Test it with a post to a random object, which should not exist.
+    """
+    chars = string.ascii_lowercase + string.digits
+    obj = '_'.join(random.choice(chars) for x in range(32))
+    url = c_url + '/' + obj
+    with timed('probe'):
+        r = swift_request('POST', url, headers=headers)
+    try:
+        r.raise_for_status()
+        # Landing here should be unlikely, but still
+        # this would mean that a write is possible.
+    except requests.RequestException as e:
+        if r.status_code == 404:
+            # Post is possible, so user has access rights.
+            pass
+        elif r.status_code == 403:
+            return False
+        else:
+            logger.exception(
+                'Failure while posting dummy object with url '
+                '%s. %s',
+                url, str(e))
+            abort(500)
+
+    return True
+
+
+def can_write(c_url, query, headers, probes=None):
+    """Return whether a write ACL exists for the container at c_url.
+
+    The result of probe_write is memoized per container and credentials
+    (token or temporary URL signature) in probes, which should be a
+    TTLCache per batch, and for WRITE_PROBE_TTL seconds across batches.
+    Concurrent checks for the same key share a single probe.
+    """
+    key = (c_url, headers.get('x-auth-token'), query)
+
+    def load():
+        return probe_cache.get_or_load(
+            key, lambda: probe_write(c_url, headers),
+            ttl=app.config.get('WRITE_PROBE_TTL', 0))
+
+    if probes is None:
+        return load()
+    return probes.get_or_load(key, load)
+
+
+def dedup_sources(c_url, oid):
+    """Return (url, copy headers) of oid in the DEDUP_CONTAINERS.
+
+    Entries of DEDUP_CONTAINERS are either '<container>' in the account of
+    c_url or '<account>/<container>'. The copy headers make a PUT to the
+    object in c_url a server-side copy from the url.
+    """
+    account_url = c_url.rsplit('/', 1)[0]
+    sources = []
+    for name in app.config.get('DEDUP_CONTAINERS', ()):
+        copy_headers = {'x-copy-from': '/' + name.split('/')[-1] + '/' + oid}
+        if '/' in name:
+            account = name.split('/')[0]
+            url = account_url.rsplit('/', 1)[0] + '/' + name
+            copy_headers['x-copy-from-account'] = account
+        else:
+            url = account_url + '/' + name
+        if url != c_url:
+            sources.append((url + '/' + oid, copy_headers))
+    return sources
+
+
+def observe_copy(c_url, oid, size, copied):
+    """Record the result of a server-side copy of oid to c_url."""
+    if copied:
+        cache_object(c_url, oid, size)
+    if metrics_enabled():
+        DEDUP_COPIES.inc(('copied' if copied else 'failed',))
+
+
+def copy_timeout():
+    """Return the (connect, read) timeout of server-side copies.
+
+    Copying large objects takes much longer than other requests, so the
+    read timeout is DEDUP_COPY_TIMEOUT instead of SWIFT_READ_TIMEOUT.
+    """
+    return (app.config.get('SWIFT_CONNECT_TIMEOUT', 10),
+            app.config.get('DEDUP_COPY_TIMEOUT', 600))
+
+
+def copy_known(c_url, oid, headers, o_size):
+    """Copy oid from a DEDUP_CONTAINERS container to c_url, if it's there.
+
+    The object is copied server-side by swift, if it exists with size
+    o_size in any of the containers. Returns whether it has been copied.
+    Failures, including connection errors, timeouts and overloaded
+    endpoints, are logged and False is returned, so that the client
+    uploads the object instead.
+    """
+    for url, copy_headers in dedup_sources(c_url, oid):
+        try:
+            r = head_object(url, headers)
+        except HTTPException as e:
+            logger.warning('Heading %s failed. %s', url, str(e))
+            return False
+        try:
+            r.raise_for_status()
+            if int(r.headers['content-length']) != o_size:
+                continue
+        except requests.RequestException:
+            continue
+        try:
+            with timed('copy'):
+                r = swift_request('PUT', c_url + '/' + oid,
+                                  headers=dict(headers, **copy_headers),
+                                  timeout=copy_timeout())
+            r.raise_for_status()
+        except (HTTPException, requests.RequestException) as e:
+            logger.warning('Copying %s to %s failed. %s', url, c_url, str(e))
+            observe_copy(c_url, oid, o_size, False)
+            return False
+        observe_copy(c_url, oid, o_size, True)
+        return True
+    return False
+
+
 def handle_ul(
-        c_url, oid, query, headers, o_size, o_data):
+        c_url, oid, query, headers, o_size, o_data, probes=None):
     """Handle upload of object by manipulating o_data dict."""
     url = c_url + '/' + oid + query
-    r = requests.head(url, headers=headers)
+    r = head_object(url, headers)
     try:
         r.raise_for_status()
     except requests.RequestException as e:
         if r.status_code == 404:
-            pass
+            # Server-side copies need token auth.
+            if not query and copy_known(c_url, oid, headers, o_size):
+                return None
         elif r.status_code == 401:
             abort(401)
         elif r.status_code == 403:
-            # It's possible that a write ACL exist. Test it with a
-            # post to a random object, which should not exist.
-            chars = string.ascii_lowercase + string.digits
-            obj = '_'.join(random.choice(chars) for x in range(32))
-            url = c_url + '/' + obj
-            r = requests.post(url, headers=headers)
-            try:
-                r.raise_for_status()
-                # Landing here should be unlikely, but still
-                # this would mean that a write is possible.
-                pass
-            except requests.RequestException as e:
-                if r.status_code == 404:
-                    # Post is possible, so user has access rights.
-                    pass
-                elif r.status_code == 403:
-                    abort(403)
-                else:
-                    logger.exception(
-                        'Failure while posting dummy object with url '
-                        '%s. %s',
-                        url, str(e))
-                    abort(500)
+            # It's possible that a write ACL exist.
+            if not can_write(c_url, query, headers, probes):
+                abort(403)
         else:
             logger.exception(
                 'Failure while heading object with url %s. %s',
@@ -121,38 +808,175 @@ def handle_ul(
 
         return True
 
+    if (app.config.get('OBJECT_CACHE_TTL', 0) and
+            'x-object-manifest' not in r.headers):
+        cache_object(c_url, oid, int(r.headers['content-length']))
 
-@app.route(
-    '/<account>/<container>/read_<readsig>/write_<writesig>/<expires_at>/'
-    'objects/batch', methods=['POST'])
-@app.route('/<account>/<container>/objects/batch', methods=['POST'])
-@app.route('/<container>/objects/batch', methods=['POST'])
-def batch_api(
-        account=None, container=None, readsig=None, writesig=None,
-        expires_at=None):
+
+def check_jobs(operation, handle, c_url, headers, token, jobs, tenant=None):
+    """Return the results of handle for all jobs, in order.
+
+    Jobs are resolved from the object cache and, for large batches, from
+    the container listing first. The remaining jobs are checked by
+    run_checks for tenant, once per distinct oid and size.
     """
-    Implementation of
-    https://github.com/git-lfs/git-lfs/blob/master/docs/api/batch.md.
+    resolved = check_cache(operation, c_url, jobs)
+    threshold = app.config.get('BATCH_LISTING_THRESHOLD', 0)
+    if token and threshold and len(jobs) - len(resolved) > threshold:
+        unresolved = [i for i in range(len(jobs)) if i not in resolved]
+        listed = check_listing(
+            operation, c_url, headers, [jobs[i] for i in unresolved])
+        for i, result in listed.items():
+            resolved[unresolved[i]] = result
+    pending = [j for i, j in enumerate(jobs) if i not in resolved]
+    # Duplicate objects are checked once.
+    unique, index = coalesce(pending)
+    checked = iter(fan_out(
+        pending, unique, index,
+        run_checks(handle, c_url, headers, unique, tenant)))
+    return [resolved[i] if i in resolved else next(checked)
+            for i in range(len(jobs))]
+
+
+def _parse_events(stream, chunk_size=65536):
+    """Yield the ijson parser events of the JSON document in stream."""
+    events = ijson.sendable_list()
+    coro = ijson.parse_coro(events, use_float=True)
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        coro.send(chunk)
+        for event in events:
+            yield event
+        del events[:]
+    coro.close()
+    for event in events:
+        yield event
+
+
+def parse_batch(stream):
+    """Parse a batch request from stream.
+
+    With ijson installed, the request is decoded incrementally and only
+    the fields used by the server are kept. Otherwise, the whole request
+    is decoded at once.
     """
-    auth = request.authorization
+    if ijson is None:
+        try:
+            return json.load(stream)
+        except ValueError:
+            abort(400)
+
+    data = {}
+    o = None
+    try:
+        for prefix, event, value in _parse_events(stream):
+            if prefix == 'objects.item':
+                if event == 'start_map':
+                    o = {}
+                elif event == 'end_map':
+                    data['objects'].append(o)
+            elif prefix in ('objects.item.oid', 'objects.item.size'):
+                o[prefix.rsplit('.', 1)[1]] = value
+            elif prefix == 'objects' and event == 'start_array':
+                data['objects'] = []
+            elif prefix == 'operation':
+                data['operation'] = value
+            elif prefix == 'transfers' and event == 'start_array':
+                data['transfers'] = []
+            elif prefix == 'transfers.item':
+                data['transfers'].append(value)
+    except ijson.JSONError:
+        abort(400)
+    return data
+
+
+def _dumps(obj):
+    """Serialize obj to JSON bytes with the configured JSON_BACKEND."""
+    backend = app.config.get('JSON_BACKEND', 'json')
+    if backend == 'orjson' and orjson is not None:
+        return orjson.dumps(obj)
+    if backend == 'ujson' and ujson is not None:
+        return ujson.dumps(obj).encode('utf-8')
+    return json.dumps(obj).encode('utf-8')
+
+
+def stream_batch(jobs, check, render, transfer):
+    """Return a streamed response for the batch.
+
+    Jobs are checked in chunks of BATCH_STREAMING_CHUNK objects, and
+    each chunk is sent as soon as it has been checked. The first chunk is
+    checked before the response is started, so that authorization errors
+    are still returned as status code. If a later chunk is aborted, the
+    abort code is returned as error of its objects and of all following
+    objects. If the client accepts it and BATCH_GZIP is set, the response
+    is gzip compressed.
+    """
+    size = app.config.get('BATCH_STREAMING_CHUNK', 1000)
+    chunks = [jobs[i:i + size] for i in range(0, len(jobs), size)]
+    first = check(chunks[0]) if chunks else []
+
+    def fragments():
+        yield b'{"objects": ['
+        error = None
+        for n, chunk in enumerate(chunks):
+            if n == 0:
+                results = first
+            elif error is None:
+                try:
+                    results = check(chunk)
+                except HTTPException as e:
+                    logger.warning('Streamed batch aborted with %s.', e.code)
+                    error = dict(code=e.code, message=e.name + '.')
+            parts = []
+            with timed('serialize'):
+                for i, job in enumerate(chunk):
+                    if error is None:
+                        o_data = render(job, results[i])
+                    else:
+                        o_data = dict(job[2], size=job[1],
+                                      authenticated=True, error=error)
+                    parts.append(_dumps(o_data))
+            yield (b', ' if n else b'') + b', '.join(parts)
+        yield b'], "transfer": ' + _dumps(transfer) + b'}'
+
+    body = fragments()
+    headers = {'Content-Type': 'application/json'}
+    if (app.config.get('BATCH_GZIP', False) and
+            'gzip' in request.accept_encodings):
+        body = _gzip(body)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(body, 200, headers)
+
+
+def _gzip(chunks):
+    """Compress an iterable of bytes with gzip."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def authenticate(auth, account, container, expires_at=None):
+    """Authenticate a batch request.
+
+    auth is the HTTP Basic authorization of the request, or None for
+    temporary URL auth. Returns a tuple of storage url, token, auth cache
+    key, TempURLSigner and expires_at timestamp.
+    """
+    cache_key = None
+    signer = None
 
     if auth:
-        # With this option it should be possible
-        # to use keystone auth, too.
-        kwargs = app.config.get('AUTH_KWARGS', {})
         try:
-            storage_url, token = client.get_auth(
-                app.config['AUTH_URL'],
-                auth.username.replace(';', ':'),
-                auth.password,
-                **kwargs)
+            storage_url, token, cache_key = get_auth(
+                auth.username.replace(';', ':'), auth.password)
         except ClientException as e:
             if e.http_status == 401:
                 abort(401)
             else:
                 abort(500)
         else:
-            query = ''
             if account:
                 # Replace default storage-account.
                 storage_url = '/'.join(
@@ -163,71 +987,569 @@ def batch_api(
             abort(401)
 
         storage_url = app.config['BASE_URL'].rstrip('/') + '/v1/' + account
+        if not expires_at:
+            signer = get_signer(account, container)
+            if signer:
+                expires_at = str(tempurl.expiry(
+                    time.time(), app.config.get('TOKEN_EXPIRY', 3600)))
 
-    if not expires_at:
-        expires_at_iso = datetime.fromtimestamp(
-            int(time.time()) + app.config.get('TOKEN_EXPIRY', 3600),
-            pytz.utc).isoformat()
-    else:
-        expires_at_iso = datetime.fromtimestamp(
-            int(expires_at), pytz.utc).isoformat()
+    return storage_url, token, cache_key, signer, expires_at
 
-    data = request.get_json()
-    logger.debug('Received Data: %s', data)
 
-    operation = data.get('operation', None)
-    if operation not in ('download', 'upload') or 'objects' not in data:
-        abort(400)
+def split_size(size, part_size, max_parts):
+    """Return the sizes of the parts to split size bytes into.
 
-    # We currently support basic and swift transfer.
-    # With swift transfer, the client does also consider LO's.
-    # swift transfer currently only supports token auth.
-    if 'swift' in data.get('transfers', []) and token:
-        transfer = 'swift'
-    else:
-        transfer = 'basic'
+    All parts but the last one have part_size bytes, unless more than
+    max_parts parts would be needed; then the parts are larger.
+    """
+    part_size = max(part_size, int(math.ceil(size / float(max_parts))))
+    count, rest = divmod(size, part_size)
+    return [part_size] * count + ([rest] if rest else [])
 
-    c_url = storage_url.rstrip('/') + '/' + container
-    objs = []
 
-    if operation == 'download':
-        handle = handle_dl
-        if not auth:
-            query = '?temp_url_prefix=&temp_url_sig={}&temp_url_expires={}'.\
-                format(readsig, expires_at)
-    else:
-        handle = handle_ul
-        if not auth:
+def segment_sizes(size):
+    """Return the sizes of the segments to upload an object of size in.
+
+    Objects up to SLO_THRESHOLD bytes are uploaded in a single part.
+    Larger objects are split into segments of SLO_SEGMENT_SIZE bytes, or
+    larger ones if more than SLO_MAX_SEGMENTS would be needed.
+    """
+    segment_size = app.config.get('SLO_SEGMENT_SIZE', 0)
+    if size <= app.config.get('SLO_THRESHOLD', segment_size):
+        return [size]
+    return split_size(
+        size, segment_size, app.config.get('SLO_MAX_SEGMENTS', 1000))
+
+
+def download_parts(size):
+    """Return the (pos, size) byte ranges to download an object in.
+
+    Objects larger than DOWNLOAD_PART_THRESHOLD bytes are split into
+    ranges of DOWNLOAD_PART_SIZE bytes, or larger ones if more than
+    DOWNLOAD_MAX_PARTS would be needed. Smaller objects are not split
+    and an empty list is returned.
+    """
+    part_size = app.config.get('DOWNLOAD_PART_SIZE', 0)
+    if not part_size or size <= app.config.get(
+            'DOWNLOAD_PART_THRESHOLD', part_size):
+        return []
+    parts = []
+    pos = 0
+    for part in split_size(
+            size, part_size, app.config.get('DOWNLOAD_MAX_PARTS', 16)):
+        parts.append((pos, part))
+        pos += part
+    return parts
+
+
+def shard(container, oid, shards):
+    """Return the name of the shard of container that oid belongs to.
+
+    Objects are spread across the shards by the first eight hex digits of
+    their oid. The shards are named <container>_<index>, with the index
+    zero-padded to the width of the largest one.
+    """
+    try:
+        n = int(oid[:8], 16)
+    except ValueError:
+        # Not a sha256 hex digest.
+        n = zlib.crc32(oid.encode('utf-8'))
+    return '{}_{:0{}d}'.format(container, n % shards, len(str(shards - 1)))
+
+
+class Batch(object):
+    """A validated batch request.
+
+    jobs is the list of (oid, o_size, o_data, query) tuples of the
+    objects, up to the first invalid object, if invalid is set.
+
+    If CONTAINER_SHARDS is set, objects are stored in the shards of the
+    container, see shard. legacy is the set of oids, which have been
+    found in the unsharded container instead.
+    """
+
+    def __init__(self, data, storage_url, container, token=None,
+                 signer=None, readsig=None, writesig=None, expires_at=None):
+        self.operation = data.get('operation', None)
+        if (self.operation not in ('download', 'upload') or
+                'objects' not in data):
+            abort(400)
+
+        # We currently support basic, multipart-basic and swift transfer.
+        # With swift transfer, the client does also consider LO's.
+        # swift transfer currently only supports token auth.
+        # With multipart-basic transfer, large objects are uploaded as
+        # static large objects.
+        transfers = data.get('transfers', [])
+        if 'swift' in transfers and token:
+            self.transfer = 'swift'
+        elif ('multipart-basic' in transfers and
+                self.operation == 'upload' and
+                app.config.get('SLO_SEGMENT_SIZE', 0)):
+            self.transfer = 'multipart-basic'
+        else:
+            self.transfer = 'basic'
+
+        if not expires_at:
+            self.expires_at_iso = datetime.fromtimestamp(
+                int(time.time()) + app.config.get('TOKEN_EXPIRY', 3600),
+                pytz.utc).isoformat()
+        else:
+            self.expires_at_iso = datetime.fromtimestamp(
+                int(expires_at), pytz.utc).isoformat()
+
+        self.token = token
+        self.signer = signer
+        self.expires_at = expires_at
+        self.container = container
+        self.base_url = storage_url.rstrip('/')
+        self.c_url = self.base_url + '/' + container
+        # Signatures of prefix-based temporary URLs are only valid for
+        # the container in the URL of the batch.
+        self.shards = 0 if readsig else app.config.get('CONTAINER_SHARDS', 0)
+        self.legacy = set()
+        # Per-object checks are scheduled fairly between tenants.
+        self.tenant = '{}/{}'.format(
+            urlsplit(self.base_url).path.rsplit('/', 1)[-1], container)
+        self.headers = {'x-auth-token': token} if token else {}
+
+        query = ''
+        if not token:
             query = '?temp_url_prefix=&temp_url_sig={}&temp_url_expires={}'.\
-                format(writesig, expires_at)
+                format(readsig if self.operation == 'download' else writesig,
+                       expires_at)
+
+        self.jobs = []
+        self.invalid = False
+        for o in data['objects']:
+            try:
+                oid = o['oid']
+                o_size = o['size']
+            except KeyError:
+                # Objects before the invalid one are checked nevertheless,
+                # so that their abort codes take precedence as before.
+                self.invalid = True
+                break
+            self.jobs.append((oid, o_size, {'oid': oid}, query))
+
+        if signer:
+            # Sign a temporary URL per object. HEAD requests are allowed
+            # with GET and PUT signatures, too.
+            self.jobs = self.sign(self.jobs)
+
+    def container_of(self, oid):
+        """Return the name of the container storing oid."""
+        if not self.shards or oid in self.legacy:
+            return self.container
+        return shard(self.container, oid, self.shards)
+
+    def url(self, oid):
+        """Return the url of the container storing oid."""
+        return self.base_url + '/' + self.container_of(oid)
+
+    def sign(self, jobs):
+        """Return jobs with the queries of signed temporary URLs."""
+        path = urlsplit(self.base_url).path
+        sigs = self.signer.sign_many(
+            'GET' if self.operation == 'download' else 'PUT',
+            int(self.expires_at),
+            [path + '/' + self.container_of(job[0]) + '/' + job[0]
+             for job in jobs])
+        return [(oid, o_size, o_data, tempurl.query(sig, self.expires_at))
+                for (oid, o_size, o_data, _), sig in zip(jobs, sigs)]
+
+    def shard_jobs(self, jobs):
+        """Return a list of (container url, job indices) of jobs."""
+        indices = {}
+        for i, job in enumerate(jobs):
+            indices.setdefault(self.url(job[0]), []).append(i)
+        return list(indices.items())
+
+    def missing(self, jobs, results):
+        """Return the indices of the jobs missing in their shard.
+
+        Their errors are removed, so that they can be checked again in
+        the unsharded container.
+        """
+        indices = []
+        for i, (job, result) in enumerate(zip(jobs, results)):
+            if self.operation == 'upload':
+                if result:
+                    indices.append(i)
+            elif job[2].get('error', {}).get('code') == 404:
+                del job[2]['error']
+                indices.append(i)
+        return indices
 
-    for o in data['objects']:
+    def unsharded(self, jobs):
+        """Return jobs to check in the unsharded container."""
+        if not self.signer:
+            return jobs
+        oids = set(job[0] for job in jobs)
+        self.legacy.update(oids)
         try:
-            oid = o['oid']
-            o_size = o['size']
-        except KeyError:
-            abort(400)
+            return self.sign(jobs)
+        finally:
+            self.legacy.difference_update(oids)
 
-        o_data = {'oid': oid}
-        href = c_url if transfer == 'swift' else c_url + '/' + oid + query
-        headers = {'x-auth-token': token} if token else {}
+    def found(self, jobs, results):
+        """Record the jobs found in the unsharded container."""
+        for job, result in zip(jobs, results):
+            if (result if self.operation == 'download' else
+                    result is None):
+                self.legacy.add(job[0])
 
-        if handle(c_url, oid, query, headers, o_size, o_data):
+    def render(self, job, success):
+        """Return the response object of job."""
+        oid, o_size, o_data, query = job
+        if self.signer and oid in self.legacy:
+            # The query of the job is signed for the shard.
+            query = self.sign([job])[0][3]
+        # With several proxies, the objects are spread across them.
+        c_url = self.url(oid)
+        if self.transfer == 'swift':
+            href = spread(c_url, oid)
+        else:
+            href = spread(c_url + '/' + oid + query, oid)
+        if success and self.transfer == 'multipart-basic':
+            o_data['actions'] = self.multipart_actions(job)
+        elif success:
             action = dict(
-                href=href, header=headers, expires_at=expires_at_iso)
-            o_data['actions'] = {operation: action}
+                href=href, header=self.headers,
+                expires_at=self.expires_at_iso)
+            if self.operation == 'download' and self.transfer == 'basic':
+                parts = download_parts(o_size)
+                if parts:
+                    # Byte ranges, which can be downloaded concurrently
+                    # instead of the whole object.
+                    action['parts'] = [dict(
+                        href=spread(href, '{}/{}'.format(oid, pos)),
+                        pos=pos, size=size,
+                        header=dict(self.headers, Range='bytes={}-{}'.format(
+                            pos, pos + size - 1)))
+                        for pos, size in parts]
+            o_data['actions'] = {self.operation: action}
 
         o_data['size'] = o_size
         o_data['authenticated'] = True
-        objs.append(o_data)
+        return o_data
+
+    def multipart_actions(self, job):
+        """Return the multipart-basic upload actions of job.
+
+        Large objects are uploaded in parts to segment objects below
+        SEGMENT_PREFIX, which are joined by the static large object
+        manifest uploaded with the commit action.
+        """
+        oid, o_size, o_data, query = job
+        sizes = segment_sizes(o_size)
+        # Segments are stored in the same container as their manifest.
+        container = self.container_of(oid)
+        c_url = self.base_url + '/' + container
+        if len(sizes) == 1:
+            return {'parts': [dict(
+                href=spread(c_url + '/' + oid + query, oid), pos=0,
+                size=o_size,
+                header=self.headers, expires_at=self.expires_at_iso)]}
+
+        names = ['{}{}/{}/{:08d}'.format(SEGMENT_PREFIX, oid, sizes[0], i)
+                 for i in range(len(sizes))]
+        if self.signer:
+            path = urlsplit(c_url).path
+            queries = [
+                tempurl.query(sig, self.expires_at)
+                for sig in self.signer.sign_many(
+                    'PUT', int(self.expires_at),
+                    [path + '/' + name for name in names])]
+        else:
+            queries = [query] * len(names)
+
+        parts = []
+        manifest = []
+        pos = 0
+        for name, size, part_query in zip(names, sizes, queries):
+            parts.append(dict(
+                href=spread(c_url + '/' + name + part_query, name),
+                pos=pos, size=size, header=self.headers,
+                expires_at=self.expires_at_iso))
+            manifest.append(
+                {'path': '/' + container + '/' + name,
+                 'size_bytes': size})
+            pos += size
+        commit = dict(
+            href=spread(c_url + '/' + oid + query, oid) +
+            ('&' if query else '?') + 'multipart-manifest=put',
+            method='PUT', header=self.headers, body=json.dumps(manifest),
+            expires_at=self.expires_at_iso)
+        return {'parts': parts, 'commit': commit}
+
+    def result(self, results):
+        """Return the response of the batch, given the results of jobs."""
+        objs = [self.render(job, success)
+                for job, success in zip(self.jobs, results)]
+        return {'objects': objs, 'transfer': self.transfer}
+
+
+def shard_checks(batch, jobs):
+    """Generate the checks of the jobs of batch, grouped by container.
+
+    Yields the url of a container and the jobs of objects stored in it,
+    once per shard, and expects their results to be sent back, see
+    drive. If CONTAINER_SHARD_FALLBACK is set, objects missing in their
+    shard are looked up in the unsharded container again, for
+    repositories which have not been migrated yet. Returns the results of
+    all jobs, in order.
+    """
+    if not batch.shards:
+        return (yield batch.c_url, jobs)
+
+    results = [None] * len(jobs)
+    for c_url, indices in batch.shard_jobs(jobs):
+        shard_results = yield c_url, [jobs[i] for i in indices]
+        for i, result in zip(indices, shard_results):
+            results[i] = result
+    if not app.config.get('CONTAINER_SHARD_FALLBACK', True):
+        return results
+    missing = batch.missing(jobs, results)
+    if missing:
+        unsharded = batch.unsharded([jobs[i] for i in missing])
+        found = yield batch.c_url, unsharded
+        batch.found(unsharded, found)
+        for i, result in zip(missing, found):
+            results[i] = result
+    return results
+
+
+def check_shards(batch, check, jobs):
+    """Return the results of check(c_url, jobs) for the jobs of batch.
+
+    See shard_checks.
+    """
+    return drive(shard_checks(batch, jobs), check)
+
+
+def route_type(account, readsig):
+    """Return the type of the route of a batch request."""
+    if readsig:
+        return 'tempurl'
+    return 'account' if account else 'container'
+
+
+def capture(data, route, container):
+    """Append the batch request data to CAPTURE_FILE, if it is set.
+
+    Only the time, route type, container, operation, transfers and the
+    oids and sizes of the objects are written as JSON line, no credentials.
+    """
+    path = app.config.get('CAPTURE_FILE')
+    if not path:
+        return
+    record = {
+        'time': round(time.time(), 3), 'route': route,
+        'container': container, 'operation': data.get('operation'),
+        'transfers': data.get('transfers', []),
+        'objects': [[o.get('oid'), o.get('size')]
+                    for o in data.get('objects', []) if isinstance(o, dict)]}
+    line = json.dumps(record, separators=(',', ':'))
+    with _capture_lock:
+        with open(path, 'a') as f:
+            f.write(line + '\n')
+
+
+def observe_request(batch):
+    """Record operation, transfer and size of batch."""
+    if metrics_enabled():
+        BATCHES.inc((batch.operation, batch.transfer))
+        BATCH_OBJECTS.observe(len(batch.jobs), (batch.operation,))
+    trace = tracing.current()
+    if trace is not None:
+        trace.attrs.update(operation=batch.operation,
+                           transfer=batch.transfer, objects=len(batch.jobs))
+
+
+def begin_trace():
+    """Start the trace of a batch, or return None if tracing is disabled.
+
+    Tracing is enabled by TRACE_SAMPLE_RATE or TRACE_SLOW_THRESHOLD.
+    """
+    rate = app.config.get('TRACE_SAMPLE_RATE', 0)
+    if not rate and not app.config.get('TRACE_SLOW_THRESHOLD', 0):
+        return None
+    return tracing.begin(
+        'batch', rate, profile=bool(app.config.get('TRACE_PROFILE_DIR')))
+
+
+def end_trace(trace, status):
+    """End the trace of a batch and write it if it is sampled or slow."""
+    if trace is None:
+        return
+    trace.attrs['status'] = status
+    if tracing.end(trace, app.config.get('TRACE_SLOW_THRESHOLD', 0)):
+        write_trace(trace)
+
+
+def write_trace(trace):
+    """Append trace as JSON line to TRACE_FILE, or log it.
+
+    Its profile, if any, is dumped to <TRACE_PROFILE_DIR>/<trace id>.prof.
+    """
+    line = json.dumps(trace.to_dict(), separators=(',', ':'), default=str)
+    path = app.config.get('TRACE_FILE')
+    if path:
+        with _trace_lock:
+            with open(path, 'a') as f:
+                f.write(line + '\n')
+    else:
+        trace_logger.info(line)
+    if trace.profiler is not None:
+        trace.profiler.dump_stats(os.path.join(
+            app.config['TRACE_PROFILE_DIR'], trace.id + '.prof'))
+
+
+def observe_batch(view):
+    """Decorate a batch view to record its duration and status code.
+
+    The batch is traced, too, see begin_trace. Streamed responses are
+    observed until their body has been sent, see observe_body.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        trace = begin_trace()
+        if trace is None and not metrics_enabled():
+            return view(*args, **kwargs)
+        start = time.perf_counter()
+
+        def finish(status):
+            if metrics_enabled():
+                BATCH_SECONDS.observe(
+                    time.perf_counter() - start, (str(status),))
+            end_trace(trace, status)
+
+        try:
+            response = view(*args, **kwargs)
+        except HTTPException as e:
+            finish(e.code)
+            raise
+        except BaseException:
+            finish(500)
+            raise
+        if isinstance(response, Response) and response.is_streamed:
+            return observe_body(response, trace, finish)
+        finish(200)
+        return response
+    return wrapper
+
+
+def observe_body(response, trace, finish):
+    """Call finish(200) once the body of the streamed response is sent.
+
+    The body is generated in the context of the request, so that its
+    spans are added to trace, which is detached from the request until
+    then.
+    """
+    context = contextvars.copy_context()
+    if trace is not None:
+        tracing.detach(trace)
+    finished = []
+
+    def close():
+        if not finished:
+            finished.append(True)
+            context.run(finish, 200)
+
+    def body(chunks):
+        chunks = iter(chunks)
+        try:
+            while True:
+                try:
+                    chunk = context.run(next, chunks)
+                except StopIteration:
+                    return
+                yield chunk
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            close()
+
+    response.response = body(response.response)
+    # The body is not iterated if the client disconnects first.
+    response.call_on_close(close)
+    return response
 
-    result = {'objects': objs, 'transfer': transfer}
+
+@app.route(
+    '/<account>/<container>/read_<readsig>/write_<writesig>/<expires_at>/'
+    'objects/batch', methods=['POST'])
+@app.route('/<account>/<container>/objects/batch', methods=['POST'])
+@app.route('/<container>/objects/batch', methods=['POST'])
+@observe_batch
+def batch_api(
+        account=None, container=None, readsig=None, writesig=None,
+        expires_at=None):
+    """
+    Implementation of
+    https://github.com/git-lfs/git-lfs/blob/master/docs/api/batch.md.
+    """
+    with timed('auth'):
+        storage_url, token, cache_key, signer, expires_at = authenticate(
+            request.authorization, account, container, expires_at)
+
+    streaming = app.config.get('BATCH_STREAMING', False)
+    with timed('parse'):
+        if streaming:
+            data = parse_batch(request.stream)
+            logger.debug(
+                'Received %s objects', len(data.get('objects', ())))
+        else:
+            data = request.get_json()
+            logger.debug('Received Data: %s', data)
+
+        batch = Batch(data, storage_url, container, token, signer, readsig,
+                      writesig, expires_at)
+    observe_request(batch)
+    capture(data, route_type(account, readsig), container)
+
+    if batch.operation == 'download':
+        handle = handle_dl
+    else:
+        # Probe write permissions only once per batch.
+        handle = functools.partial(handle_ul, probes=TTLCache(ttl=None))
+
+    def check(jobs):
+        try:
+            with timed('check'):
+                return check_shards(batch, lambda c_url, jobs: check_jobs(
+                    batch.operation, handle, c_url, batch.headers, token,
+                    jobs, batch.tenant), jobs)
+        except HTTPException as e:
+            if e.code == 401 and cache_key:
+                # The cached token might have been revoked or expired.
+                auth_cache.invalidate(cache_key)
+            raise
+
+    if streaming and not batch.invalid:
+        return stream_batch(batch.jobs, check, batch.render, batch.transfer)
+
+    results = check(batch.jobs)
+    if batch.invalid:
+        abort(400)
+
+    with timed('serialize'):
+        result = batch.result(results)
+        body = json.dumps(result)
 
     logger.debug('Response %s', result)
-    return json.dumps(result), 200, {'Content-Type': 'application/json'}
+    return body, 200, {'Content-Type': 'application/json'}
+
+
+@app.route('/metrics')
+def metrics_api():
+    """Expose the metrics in the Prometheus text format."""
+    if not metrics_enabled():
+        abort(404)
+    return registry.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
 
 
 if __name__ == "__main__":
-    if 'AUTH_URL' not in app.config and 'BASE_URL' not in app.config:
-        raise Exception('AUTH_URL or BASE_URL must be specified.')
-    app.run()
+    from git_lfs_swift_server import cli
+    cli.main(['--mode', 'development'] + sys.argv[1:])
@@ -0,0 +1,467 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import math
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+import zlib
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+# Responses of overloaded or failing proxies, which are retried.
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+def endpoint(url):
+    """Return the (scheme, netloc) tuple identifying a swift endpoint."""
+    parts = urlsplit(url)
+    return parts.scheme, parts.netloc
+
+
+class EndpointUnavailable(Exception):
+    """No request has been sent, because the endpoint is overloaded.
+
+    retry_after is the number of seconds after which a request might be
+    possible again.
+    """
+
+    def __init__(self, message, retry_after):
+        super(EndpointUnavailable, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """Stop sending requests to an endpoint after consecutive failures.
+
+    After threshold consecutive failures, the circuit opens and requests
+    are refused for timeout seconds. Then a single trial request is let
+    through, which closes the circuit on success or opens it again. If
+    the trial ends without an outcome, e.g. because it was cancelled, it
+    must be released, so that the next request is let through instead.
+    """
+
+    def __init__(self, threshold, timeout):
+        self.threshold = threshold
+        self.timeout = timeout
+        self.failures = 0
+        self._opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def closed(self):
+        with self._lock:
+            return self._opened is None
+
+    def check(self, url):
+        """Raise EndpointUnavailable if no request to url may be sent.
+
+        Returns whether the request is the trial request.
+        """
+        with self._lock:
+            if self._opened is None:
+                return False
+            remaining = self._opened + self.timeout - time.monotonic()
+            if remaining <= 0 and not self._trial:
+                self._trial = True
+                return True
+        raise EndpointUnavailable(
+            'Circuit open for {}.'.format(url),
+            max(1, int(math.ceil(remaining))))
+
+    def record(self, success):
+        """Record the outcome of a request."""
+        with self._lock:
+            if success:
+                self.failures = 0
+                self._opened = None
+            else:
+                self.failures += 1
+                if self._trial or self.failures >= self.threshold:
+                    self._opened = time.monotonic()
+            self._trial = False
+
+    def release(self):
+        """Let another trial through after a trial without outcome."""
+        with self._lock:
+            self._trial = False
+
+
+class _Resilience(object):
+    """Retries, circuit breakers and concurrency limits per endpoint.
+
+    Requests failing with a connection error, a timeout or a status code
+    in RETRY_STATUSES are retried up to retries times, after a random
+    delay of up to backoff * 2 ** attempt seconds, but at most
+    backoff_max seconds. If breaker_threshold is set, every endpoint gets
+    a CircuitBreaker. If max_concurrency is set, at most that many
+    requests are sent to every endpoint at the same time, and waiting for
+    a slot longer than queue_timeout seconds raises EndpointUnavailable.
+    """
+
+    def __init__(self, retries=0, backoff=0.1, backoff_max=2,
+                 breaker_threshold=0, breaker_timeout=30, max_concurrency=0,
+                 queue_timeout=10):
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self._breakers = {}
+        self._limiters = {}
+        self._resilience_lock = threading.Lock()
+
+    def breaker(self, url):
+        """Return the CircuitBreaker of the endpoint of url, or None."""
+        if not self.breaker_threshold:
+            return None
+        key = endpoint(url)
+        with self._resilience_lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = self._breakers[key] = CircuitBreaker(
+                    self.breaker_threshold, self.breaker_timeout)
+            return breaker
+
+    def limiter(self, url):
+        """Return the semaphore of the endpoint of url, or None."""
+        if not self.max_concurrency:
+            return None
+        key = endpoint(url)
+        with self._resilience_lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                limiter = self._limiters[key] = self._semaphore()
+            return limiter
+
+    def delay(self, attempt, response=None):
+        """Return the seconds to wait before retrying attempt."""
+        delay = random.uniform(0, self.backoff * 2 ** attempt)
+        if response is not None:
+            try:
+                # Honor Retry-After of 429 and 503 responses.
+                delay = max(delay, float(response.headers['retry-after']))
+            except (KeyError, TypeError, ValueError):
+                pass
+        return min(delay, self.backoff_max)
+
+    def _failed(self, attempt, breaker):
+        """Record a failed attempt and return whether to retry it."""
+        if breaker is not None:
+            breaker.record(False)
+        return attempt < self.retries
+
+    def _interrupted(self, trial, breaker):
+        """Release the trial of a request ended without outcome."""
+        if trial:
+            breaker.release()
+
+    def _unavailable(self, url):
+        return EndpointUnavailable(
+            'Too many concurrent requests to {}.'.format(url),
+            max(1, int(self.queue_timeout)))
+
+
+class SessionPool(_Resilience):
+    """Keep-alive HTTP sessions to swift, one per endpoint.
+
+    Every session keeps up to pool_size idle connections, so consecutive
+    requests to the same proxy reuse TCP and TLS connections. timeout is
+    passed to every request, either as a single value or as a
+    (connect, read) tuple. See _Resilience for the other arguments.
+    """
+
+    def __init__(self, pool_size=10, timeout=None, keepalive=True, **kwargs):
+        super(SessionPool, self).__init__(**kwargs)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self):
+        return threading.BoundedSemaphore(self.max_concurrency)
+
+    def session(self, url):
+        """Return the session for the endpoint of url."""
+        key = endpoint(url)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount(key[0] + '://', adapter)
+                if not self.keepalive:
+                    session.headers['Connection'] = 'close'
+                self._sessions[key] = session
+            return session
+
+    def request(self, method, url, **kwargs):
+        """Send a request with the given method to url.
+
+        Returns the response of the last attempt, or raises the
+        connection error or timeout of the last attempt.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        send = getattr(self.session(url), method.lower())
+        breaker = self.breaker(url)
+        limiter = self.limiter(url)
+        attempt = 0
+        while True:
+            trial = breaker is not None and breaker.check(url)
+            if limiter is not None and not limiter.acquire(
+                    timeout=self.queue_timeout):
+                self._interrupted(trial, breaker)
+                raise self._unavailable(url)
+            r = None
+            try:
+                r = send(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if not self._failed(attempt, breaker):
+                    raise
+            except requests.RequestException:
+                # E.g. a broken chunked response, which is not retried.
+                self._failed(self.retries, breaker)
+                raise
+            except BaseException:
+                # E.g. a gevent timeout, which says nothing about swift.
+                self._interrupted(trial, breaker)
+                raise
+            else:
+                if r.status_code not in RETRY_STATUSES:
+                    if breaker is not None:
+                        breaker.record(True)
+                    return r
+                if not self._failed(attempt, breaker):
+                    return r
+            finally:
+                if limiter is not None:
+                    limiter.release()
+            time.sleep(self.delay(attempt, r))
+            attempt += 1
+
+    def close(self):
+        """Close all sessions and their connections."""
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+class AsyncSessionPool(_Resilience):
+    """asyncio counterpart of SessionPool, based on httpx.
+
+    The clients are bound to the event loop they are first used in.
+    """
+
+    def __init__(self, pool_size=10, timeout=None, keepalive=True, **kwargs):
+        if httpx is None:
+            raise RuntimeError('httpx is required for AsyncSessionPool.')
+        super(AsyncSessionPool, self).__init__(**kwargs)
+        self.pool_size = pool_size
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        self.timeout = httpx.Timeout(timeout)
+        self.keepalive = keepalive
+        self._clients = {}
+
+    def client(self, url):
+        """Return the client for the endpoint of url."""
+        key = endpoint(url)
+        client = self._clients.get(key)
+        if client is None:
+            limits = httpx.Limits(
+                max_connections=None,
+                max_keepalive_connections=(
+                    self.pool_size if self.keepalive else 0))
+            client = httpx.AsyncClient(limits=limits)
+            self._clients[key] = client
+        return client
+
+    def _semaphore(self):
+        return asyncio.Semaphore(self.max_concurrency)
+
+    async def request(self, method, url, **kwargs):
+        """Send a request with the given method to url.
+
+        See SessionPool.request.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        send = getattr(self.client(url), method.lower())
+        breaker = self.breaker(url)
+        limiter = self.limiter(url)
+        attempt = 0
+        while True:
+            trial = breaker is not None and breaker.check(url)
+            if limiter is not None:
+                try:
+                    await asyncio.wait_for(
+                        limiter.acquire(), self.queue_timeout)
+                except asyncio.TimeoutError:
+                    self._interrupted(trial, breaker)
+                    raise self._unavailable(url)
+                except BaseException:
+                    self._interrupted(trial, breaker)
+                    raise
+            r = None
+            try:
+                r = await send(url, **kwargs)
+            except httpx.TransportError:
+                if not self._failed(attempt, breaker):
+                    raise
+            except httpx.RequestError:
+                # E.g. an undecodable response, which is not retried.
+                self._failed(self.retries, breaker)
+                raise
+            except BaseException:
+                # E.g. the batch was aborted and its checks were cancelled.
+                self._interrupted(trial, breaker)
+                raise
+            else:
+                if r.status_code not in RETRY_STATUSES:
+                    if breaker is not None:
+                        breaker.record(True)
+                    return r
+                if not self._failed(attempt, breaker):
+                    return r
+            finally:
+                if limiter is not None:
+                    limiter.release()
+            await asyncio.sleep(self.delay(attempt, r))
+            attempt += 1
+
+    async def close(self):
+        """Close all clients and their connections."""
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.aclose()
+
+
+class ProxyPool(object):
+    """Equivalent swift proxies, ranked by latency.
+
+    The latency of every proxy is tracked as exponentially weighted moving
+    average of the durations passed to observe, with weight alpha for the
+    newest one. A proxy is unhealthy after a failed request or health
+    check, until its next successful health check. If no proxy is
+    healthy, all of them are used.
+
+    Without health checks, retry should be set: best then returns an
+    unhealthy proxy once every retry seconds for a trial request, and a
+    successful request makes it healthy again.
+    """
+
+    def __init__(self, proxies, alpha=0.3, retry=None):
+        self.proxies = [p.rstrip('/') for p in proxies]
+        self.alpha = alpha
+        self.retry = retry
+        self.latency = dict.fromkeys(self.proxies)
+        self.healthy = dict.fromkeys(self.proxies, True)
+        self._failed = dict.fromkeys(self.proxies, 0)
+        self._lock = threading.Lock()
+
+    def observe(self, proxy, seconds=None, ok=True):
+        """Record a request to proxy, which took seconds.
+
+        If seconds is None, only the health of the proxy is recorded.
+        """
+        with self._lock:
+            if proxy not in self.healthy:
+                return
+            if not ok:
+                self.healthy[proxy] = False
+                self._failed[proxy] = time.monotonic()
+                return
+            if self.retry is not None:
+                self.healthy[proxy] = True
+            if seconds is None:
+                return
+            latency = self.latency[proxy]
+            self.latency[proxy] = seconds if latency is None else (
+                self.alpha * seconds + (1 - self.alpha) * latency)
+
+    def candidates(self):
+        """Return the healthy proxies, or all if none is healthy."""
+        with self._lock:
+            healthy = [p for p in self.proxies if self.healthy[p]]
+        return healthy or self.proxies
+
+    def best(self):
+        """Return the healthy proxy with the lowest latency.
+
+        Proxies without any observed latency are tried first. If retry is
+        set, an unhealthy proxy is returned after retry seconds instead.
+        """
+        if self.retry is not None:
+            with self._lock:
+                now = time.monotonic()
+                for proxy in self.proxies:
+                    if (not self.healthy[proxy] and
+                            now - self._failed[proxy] >= self.retry):
+                        self._failed[proxy] = now
+                        return proxy
+        latency = self.latency
+        return min(self.candidates(), key=lambda p: (
+            latency[p] is not None, latency[p] or 0))
+
+    def pick(self, key):
+        """Return a healthy proxy for key, spreading keys across proxies."""
+        candidates = self.candidates()
+        return candidates[zlib.crc32(key.encode('utf-8')) % len(candidates)]
+
+    def route(self, url, key=None):
+        """Return url on the proxy for key, or the best proxy."""
+        parts = urlsplit(url)
+        if not parts.netloc:
+            return url
+        proxy = self.best() if key is None else self.pick(key)
+        return proxy + url[len(parts.scheme) + 3 + len(parts.netloc):]
+
+    def proxy(self, url):
+        """Return the proxy of url, or None if it is not in the pool."""
+        parts = urlsplit(url)
+        proxy = parts.scheme + '://' + parts.netloc
+        return proxy if proxy in self.healthy else None
+
+    def check(self, get, timeout=None):
+        """Check the health of all proxies with their healthcheck path.
+
+        get is called with the url and timeout and returns a response.
+        """
+        for proxy in self.proxies:
+            start = time.perf_counter()
+            try:
+                r = get(proxy + '/healthcheck', timeout=timeout)
+                ok = r.status_code == 200
+            except requests.RequestException:
+                ok = False
+            if ok:
+                with self._lock:
+                    self.healthy[proxy] = True
+            self.observe(proxy, time.perf_counter() - start, ok)
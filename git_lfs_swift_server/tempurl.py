@@ -0,0 +1,68 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import hmac
+import math
+
+from .cache import TTLCache
+
+# Expiry times are rounded up to multiples of this many seconds, so that
+# signatures can be reused by consecutive batches.
+EXPIRY_STEP = 60
+
+
+def expiry(now, lifetime):
+    """Return the expiry timestamp for URLs valid for lifetime seconds."""
+    return int(math.ceil((now + lifetime) / float(EXPIRY_STEP))) * EXPIRY_STEP
+
+
+def query(sig, expires):
+    """Return the query string of a temporary URL."""
+    return '?temp_url_sig={}&temp_url_expires={}'.format(sig, expires)
+
+
+class TempURLSigner(object):
+    """Sign swift temporary URLs with HMAC-SHA256.
+
+    The keyed HMAC state is computed once and copied for every signature,
+    and signatures are cached by (method, expires, path).
+    """
+
+    def __init__(self, key, cache_size=10000):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        self._hmac = hmac.new(key, digestmod=hashlib.sha256)
+        self._cache = TTLCache(maxsize=cache_size)
+
+    def sign(self, method, expires, path):
+        """Return the signature for method on path until expires."""
+        return self.sign_many(method, expires, [path])[0]
+
+    def sign_many(self, method, expires, paths):
+        """Return the signatures for method on all paths until expires."""
+        prefix = '{}\n{}\n'.format(method, int(expires)).encode('utf-8')
+        sigs = []
+        for path in paths:
+            key = (method, expires, path)
+            sig = self._cache.get(key)
+            if sig is None:
+                h = self._hmac.copy()
+                h.update(prefix + path.encode('utf-8'))
+                sig = h.hexdigest()
+                self._cache.set(key, sig)
+            sigs.append(sig)
+        return sigs
@@ -0,0 +1,149 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sampled tracing of requests.
+
+A Trace records spans, i.e. named durations with optional attributes,
+relative to its start. The trace of the current request is kept in a
+context variable, so spans can be added from anywhere below it.
+"""
+
+import contextvars
+import cProfile
+import random
+import threading
+import time
+import uuid
+
+_current = contextvars.ContextVar('git_lfs_swift_trace', default=None)
+
+
+def current():
+    """Return the trace of the current request, or None."""
+    return _current.get()
+
+
+class _Span(object):
+
+    __slots__ = ('trace', 'name', 'inner', 'attrs', 'start')
+
+    def __init__(self, trace, name, inner, attrs):
+        self.trace = trace
+        self.name = name
+        self.inner = inner
+        self.attrs = attrs
+
+    def __enter__(self):
+        if self.inner is not None:
+            self.inner.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.add(self.name, self.start,
+                       time.perf_counter() - self.start, **self.attrs)
+        if self.inner is not None:
+            return self.inner.__exit__(*exc_info)
+
+
+class Trace(object):
+    """The spans of a request.
+
+    sampled is whether the trace has been selected by the sample rate.
+    Other traces are only kept if they are slow, see end.
+    """
+
+    def __init__(self, name, sampled=False):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.sampled = sampled
+        self.slow = False
+        self.time = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.attrs = {}
+        self.spans = []
+        self.profiler = None
+        self._token = None
+        self._lock = threading.Lock()
+
+    def add(self, name, start, seconds, **attrs):
+        """Add a span, which started at perf_counter() start."""
+        span = [name, round((start - self.start) * 1000, 3),
+                round(seconds * 1000, 3)]
+        if attrs:
+            span.append(attrs)
+        with self._lock:
+            self.spans.append(span)
+
+    def span(self, name, inner=None, **attrs):
+        """Return a context manager adding a span of its duration.
+
+        inner is an optional context manager, which is entered, too.
+        """
+        return _Span(self, name, inner, attrs)
+
+    def to_dict(self):
+        """Return the trace as a dict. Offsets and durations are in ms."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s[1])
+        return dict(
+            self.attrs, trace=self.id, name=self.name, time=self.time,
+            ms=round(self.duration * 1000, 3), sampled=self.sampled,
+            slow=self.slow, spans=spans)
+
+
+def begin(name, sample_rate=0, profile=False):
+    """Start a trace and make it the current one.
+
+    The trace is sampled with probability sample_rate. If profile is set,
+    sampled traces are profiled with cProfile.
+    """
+    trace = Trace(name, sampled=random.random() < sample_rate)
+    if trace.sampled and profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is active.
+            pass
+        else:
+            trace.profiler = profiler
+    trace._token = _current.set(trace)
+    return trace
+
+
+def detach(trace):
+    """Stop trace from being the current one, without ending it.
+
+    Used when the request outlives its context, e.g. a streamed response.
+    """
+    if trace._token is not None:
+        _current.reset(trace._token)
+        trace._token = None
+
+
+def end(trace, slow_threshold=0):
+    """Stop trace and return whether it should be kept.
+
+    Sampled traces and traces lasting at least slow_threshold seconds,
+    if it is set, are kept.
+    """
+    trace.duration = time.perf_counter() - trace.start
+    if trace.profiler is not None:
+        trace.profiler.disable()
+    detach(trace)
+    trace.slow = bool(slow_threshold) and trace.duration >= slow_threshold
+    return trace.sampled or trace.slow
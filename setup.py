@@ -19,7 +19,12 @@ setup(
     version="0.1",
     packages=['git_lfs_swift_server'],
     install_requires=['Flask', 'python-swiftclient', 'pytz', 'requests'],
-    tests_require='mock',
+    extras_require={'streaming': ['ijson', 'orjson'], 'asgi': ['httpx'],
+                    'production': ['gunicorn'],
+                    'gevent': ['gunicorn', 'gevent']},
+    tests_require=['mock', 'httpx'],
+    entry_points={'console_scripts': [
+        'git-lfs-swift-server = git_lfs_swift_server.cli:main']},
     author="Christopher Bartz",
     author_email="bartz@dkrz.de",
     description="git lfs server implementation for OpenStack Swift",
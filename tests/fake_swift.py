@@ -0,0 +1,271 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local, in-process stand-in for a swift proxy.
+
+It implements just enough of the swift API for the server: v1.0 auth,
+healthcheck, HEAD/GET/PUT/POST of objects, GET of JSON container listings and
+temporary URLs (signatures are not verified). Objects only have a size,
+their content is synthetic: the byte at offset i is i % 256.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+LISTING_LIMIT = 10000
+CHUNK_SIZE = 65536
+_PATTERN = bytes(range(256)) * (2 * CHUNK_SIZE // 256)
+
+
+def oid(i):
+    """Return a deterministic LFS oid."""
+    return hashlib.sha256(str(i).encode('ascii')).hexdigest()
+
+
+def content(start, end):
+    """Return the synthetic content of an object from start to end."""
+    return b''.join(_chunks(start, end))
+
+
+def _chunks(start, end):
+    while start <= end:
+        n = min(CHUNK_SIZE, end - start + 1)
+        yield _PATTERN[start % 256:start % 256 + n]
+        start += n
+
+
+class FakeSwift(object):
+    """Swift stand-in serving on a local port in a background thread.
+
+    latency is the delay in seconds added to every request, bandwidth
+    the maximum rate of every object download in bytes per second. Every
+    user gets the account AUTH_<user> and a token. Requests to containers
+    in forbidden are answered with 403 for reads, but allow writes, like
+    a write-only ACL.
+    """
+
+    def __init__(self, latency=0, users=None, forbidden=(), bandwidth=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.users = users if users is not None else {'test:tester': 'x'}
+        self.forbidden = set(forbidden)
+        self.objects = {}
+        self.tokens = {}
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.swift = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    @property
+    def auth_url(self):
+        return self.url + '/auth/v1.0'
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, args=(0.05,))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def populate(self, account, container, count, size=1, start=0):
+        """Add count objects named by oid(i) with the given size."""
+        objects = self.objects.setdefault((account, container), {})
+        for i in range(start, start + count):
+            objects[oid(i)] = size
+
+    def token(self, user):
+        """Return the account and a token of user."""
+        account = 'AUTH_' + user.split(':')[0]
+        with self._lock:
+            token = self.tokens.setdefault(
+                user, 'tk' + hashlib.md5(user.encode()).hexdigest())
+        return account, token
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def swift(self):
+        return self.server.swift
+
+    def _reply(self, status, headers=None, body=b''):
+        self.send_response(status)
+        headers = dict(headers or {})
+        headers.setdefault('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _route(self):
+        """Return (account, container, obj, query) and check the auth.
+
+        Returns None after replying with an error.
+        """
+        swift = self.swift
+        if swift.latency:
+            time.sleep(swift.latency)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(
+            url.query, keep_blank_values=True).items()}
+        parts = unquote(url.path).split('/', 4)[1:]
+        with swift._lock:
+            swift.requests.append((self.command, url.path))
+        if len(parts) < 3 or parts[0] != 'v1':
+            self._reply(404)
+            return None
+        account, container = parts[1], parts[2]
+        obj = parts[3] if len(parts) > 3 else None
+
+        if 'temp_url_sig' in query:
+            if obj is None or self.command not in ('GET', 'HEAD', 'PUT'):
+                self._reply(401)
+                return None
+        else:
+            token = self.headers.get('X-Auth-Token')
+            if token not in swift.tokens.values():
+                self._reply(401)
+                return None
+            users = [u for u, t in swift.tokens.items() if t == token]
+            if swift.token(users[0])[0] != account:
+                self._reply(403)
+                return None
+        if (container in swift.forbidden and
+                self.command in ('GET', 'HEAD')):
+            self._reply(403)
+            return None
+        return account, container, obj, query
+
+    def do_GET(self):
+        if self.path == '/healthcheck':
+            with self.swift._lock:
+                self.swift.requests.append(('GET', self.path))
+            return self._reply(200, body=b'OK')
+        if self.path.startswith('/auth/'):
+            user = self.headers.get('X-Auth-User')
+            if self.swift.users.get(user) != self.headers.get('X-Auth-Key'):
+                return self._reply(401)
+            account, token = self.swift.token(user)
+            return self._reply(200, {
+                'X-Storage-Url': self.swift.url + '/v1/' + account,
+                'X-Auth-Token': token})
+
+        route = self._route()
+        if route is None:
+            return
+        account, container, obj, query = route
+        objects = self.swift.objects.get((account, container), {})
+        if obj is None:
+            return self._listing(objects, query)
+        if obj not in objects:
+            return self._reply(404)
+        size = objects[obj]
+        start, end = 0, size - 1
+        status = 200
+        headers = {}
+        if self.headers.get('Range', '').startswith('bytes='):
+            first, last = self.headers['Range'][6:].split('-')
+            start, end = int(first), min(int(last or end), end)
+            status = 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, end, size)
+        headers['Content-Length'] = str(end - start + 1)
+        self._reply(status, headers)
+        sent = 0
+        began = time.time()
+        for chunk in _chunks(start, end):
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if self.swift.bandwidth:
+                delay = sent / float(self.swift.bandwidth) - (
+                    time.time() - began)
+                if delay > 0:
+                    time.sleep(delay)
+
+    def _listing(self, objects, query):
+        limit = min(int(query.get('limit', LISTING_LIMIT)), LISTING_LIMIT)
+        marker = query.get('marker', '')
+        end_marker = query.get('end_marker')
+        prefix = query.get('prefix', '')
+        names = sorted(
+            n for n in objects
+            if n > marker and n.startswith(prefix) and
+            (not end_marker or n < end_marker))[:limit]
+        body = json.dumps(
+            [{'name': n, 'bytes': objects[n]} for n in names]).encode()
+        self._reply(200, {'Content-Type': 'application/json'}, body)
+
+    def do_HEAD(self):
+        route = self._route()
+        if route is None:
+            return
+        account, container, obj, query = route
+        objects = self.swift.objects.get((account, container), {})
+        if obj is None:
+            return self._reply(204, {'X-Container-Object-Count':
+                                     str(len(objects))})
+        if obj not in objects:
+            return self._reply(404)
+        self._reply(200, {'Content-Length': str(objects[obj])})
+
+    def do_PUT(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        route = self._route()
+        if route is None:
+            return
+        account, container, obj, query = route
+        if obj is not None:
+            with self.swift._lock:
+                self.swift.objects.setdefault(
+                    (account, container), {})[obj] = length
+        self._reply(201)
+
+    def do_POST(self):
+        route = self._route()
+        if route is None:
+            return
+        account, container, obj, query = route
+        objects = self.swift.objects.get((account, container), {})
+        self._reply(202 if obj in objects else 404)
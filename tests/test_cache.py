@@ -0,0 +1,130 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+
+from mock import Mock, patch
+
+from git_lfs_swift_server.cache import SingleFlight, TTLCache
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        c = TTLCache(maxsize=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        self.assertEqual(c.get('a'), 1)
+        c.set('c', 3)
+        self.assertIsNone(c.get('b'))
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('c'), 3)
+        self.assertEqual(len(c), 2)
+        self.assertEqual(c.stats(), {'size': 2, 'hits': 3, 'misses': 1})
+
+    def test_expiry(self):
+        c = TTLCache(ttl=10)
+        with patch('time.time', Mock(return_value=100)):
+            c.set('a', 1)
+            c.set('b', 2, ttl=None)
+            c.set('c', 3, ttl=0)
+        with patch('time.time', Mock(return_value=109)):
+            self.assertEqual(c.get('a'), 1)
+        with patch('time.time', Mock(return_value=110)):
+            self.assertIsNone(c.get('a'))
+            self.assertEqual(c.get('b'), 2)
+            self.assertIsNone(c.get('c'))
+
+    def test_invalidate(self):
+        c = TTLCache()
+        c.set('a', 1)
+        c.invalidate('a')
+        c.invalidate('b')
+        self.assertIsNone(c.get('a'))
+        c.set('a', 1)
+        c.clear()
+        self.assertEqual(c.stats(), {'size': 0, 'hits': 0, 'misses': 0})
+
+    def test_get_or_load_single_flight(self):
+        c = TTLCache()
+        started = threading.Event()
+        calls = []
+
+        def load():
+            calls.append(1)
+            started.set()
+            time.sleep(0.05)
+            return 'value'
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(c.get_or_load('k', load)))
+            for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, ['value'] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(c.misses, 1)
+        self.assertEqual(c.hits, 4)
+
+    def test_get_or_load_exception(self):
+        c = TTLCache()
+        self.assertRaises(
+            ValueError, c.get_or_load, 'k', Mock(side_effect=ValueError))
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.get_or_load('k', lambda: 1), 1)
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_do(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def func():
+            calls.append(1)
+            release.wait(5)
+            if len(calls) > 1:
+                raise ValueError
+            return 'value'
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(flight.do('k', func)))
+            for _ in range(5)]
+        for t in threads:
+            t.start()
+        while flight.shared < 4:
+            time.sleep(0.001)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, ['value'] * 5)
+        self.assertEqual(len(calls), 1)
+
+        # Results are not kept after the call, exceptions are shared.
+        self.assertRaises(ValueError, flight.do, 'k', func)
+        self.assertEqual(flight.do('other', lambda: 1), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from mock import patch
+
+from git_lfs_swift_server import app, cli
+
+
+class TestCLI(unittest.TestCase):
+
+    def test_validate(self):
+        self.assertEqual(cli.validate({}),
+                         'AUTH_URL or BASE_URL must be specified.')
+        self.assertIsNone(cli.validate({'AUTH_URL': 'http://swift/auth'}))
+        self.assertIsNone(cli.validate({'BASE_URL': 'https://swift/v1/'}))
+        self.assertIn('AUTH_URL', cli.validate({'AUTH_URL': 'swift/auth'}))
+        self.assertIn('BASE_URL', cli.validate({'BASE_URL': 'ftp://swift'}))
+
+    def test_invalid_counts(self):
+        for name in 'workers', 'threads', 'connections':
+            with self.assertRaises(SystemExit):
+                cli.parse_args(['--{}'.format(name), '0'])
+
+    def test_gunicorn_options(self):
+        _, args = cli.parse_args(['--mode', 'prefork', '--workers', '3'])
+        options = cli.gunicorn_options(args)
+        self.assertEqual(options['worker_class'], 'sync')
+        self.assertEqual(options['workers'], 3)
+        self.assertNotIn('threads', options)
+        self.assertFalse(options['preload_app'])
+
+        _, args = cli.parse_args(['--threads', '4', '--keepalive', '10'])
+        options = cli.gunicorn_options(args)
+        self.assertEqual(options['worker_class'], 'gthread')
+        self.assertEqual(options['threads'], 4)
+        self.assertEqual(options['keepalive'], 10)
+
+        _, args = cli.parse_args(['--mode', 'gevent', '--connections', '50',
+                                  '--pid', '/tmp/pid'])
+        options = cli.gunicorn_options(args)
+        self.assertEqual(options['worker_class'], 'gevent')
+        self.assertEqual(options['worker_connections'], 50)
+        self.assertEqual(options['pidfile'], '/tmp/pid')
+
+    def test_main_validates_config(self):
+        environ = {k: v for k, v in os.environ.items()
+                   if not k.startswith('GIT_LFS_SWIFT_')}
+        with tempfile.NamedTemporaryFile('w', suffix='.py') as settings, \
+                patch.dict(os.environ, environ, clear=True), \
+                patch.object(app, 'run') as run:
+            settings.write('AUTH_URL = "swift/auth"\n')
+            settings.flush()
+            with self.assertRaises(SystemExit):
+                cli.main(['--mode', 'development'])
+            with self.assertRaises(SystemExit):
+                cli.main(['--mode', 'development', '--settings',
+                          settings.name])
+            self.assertFalse(run.called)
+
+            del os.environ['GIT_LFS_SWIFT_SETTINGS_FILE']
+            os.environ['GIT_LFS_SWIFT_BASE_URL'] = 'http://swift/v1/'
+            cli.main(['--mode', 'development', '--bind', 'host:8080'])
+            run.assert_called_once_with(host='host', port=8080,
+                                        threaded=True)
+
+    def test_master_does_not_import_app(self):
+        # Workers import the app after forking, so that reloads read the
+        # settings file again.
+        code = (
+            'import sys\n'
+            'from git_lfs_swift_server import cli\n'
+            'cli.serve = lambda options: print(sorted(sys.modules))\n'
+            'cli.main(["--mode", "prefork"])\n')
+        env = dict(os.environ, GIT_LFS_SWIFT_AUTH_URL='http://swift/auth')
+        out = subprocess.check_output([sys.executable, '-c', code], env=env)
+        self.assertIn(b'git_lfs_swift_server.cli', out)
+        self.assertNotIn(b'git_lfs_swift_server.server', out)
@@ -0,0 +1,147 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from base64 import b64encode
+import json
+from concurrent.futures import ThreadPoolExecutor
+import unittest
+
+from mock import patch
+import requests
+
+from git_lfs_swift_server import app, server
+
+from tests.fake_swift import content, FakeSwift, oid
+
+
+class TestFakeSwift(unittest.TestCase):
+    """Run batches against a local swift stand-in, without mocks."""
+
+    def setUp(self):
+        self.swift = FakeSwift(forbidden=['dropbox']).start()
+        self.addCleanup(self.swift.stop)
+        self.swift.populate('AUTH_test', 'lfs', 3, size=5)
+        app.config['AUTH_URL'] = self.swift.auth_url
+        self.app = app.test_client()
+        self.headers = {
+            'Authorization': 'Basic ' + b64encode(b'test;tester:x').decode(),
+            'Content-Type': 'application/json'}
+
+    def post(self, container, operation, objects):
+        r = self.app.post(
+            '/{}/objects/batch'.format(container), headers=self.headers,
+            data=json.dumps({'operation': operation, 'objects': objects}))
+        return r.status_code, json.loads(r.data) if r.status_code == 200 \
+            else None
+
+    def test_download(self):
+        objects = [{'oid': oid(0), 'size': 5}, {'oid': oid(1), 'size': 4},
+                   {'oid': oid(5), 'size': 5}]
+        status, data = self.post('lfs', 'download', objects)
+        self.assertEqual(status, 200)
+        o = data['objects']
+        self.assertEqual(
+            o[0]['actions']['download']['href'],
+            self.swift.url + '/v1/AUTH_test/lfs/' + oid(0))
+        self.assertEqual(o[1]['error']['code'], 422)
+        self.assertEqual(o[2]['error']['code'], 404)
+
+        self.assertEqual(self.post('dropbox', 'download', objects)[0], 403)
+
+    def test_download_parts(self):
+        app.config['DOWNLOAD_PART_SIZE'] = 100
+        self.addCleanup(app.config.pop, 'DOWNLOAD_PART_SIZE')
+        self.swift.populate('AUTH_test', 'lfs', 1, size=1000, start=10)
+        objects = [{'oid': oid(0), 'size': 5}, {'oid': oid(10), 'size': 1000}]
+        status, data = self.post('lfs', 'download', objects)
+        self.assertEqual(status, 200)
+        self.assertNotIn('parts', data['objects'][0]['actions']['download'])
+        parts = data['objects'][1]['actions']['download']['parts']
+        self.assertEqual(len(parts), 10)
+
+        def get(part):
+            r = requests.get(part['href'], headers=part['header'])
+            self.assertEqual(r.status_code, 206)
+            self.assertEqual(len(r.content), part['size'])
+            return part['pos'], r.content
+
+        with ThreadPoolExecutor(4) as executor:
+            ranges = sorted(executor.map(get, parts))
+        self.assertEqual(b''.join(r[1] for r in ranges), content(0, 999))
+
+    def test_proxies(self):
+        proxies = [self.swift.url, self.swift.url.replace(
+            '127.0.0.1', 'localhost')]
+        settings = {'SWIFT_PROXIES': proxies, 'SWIFT_HEALTH_INTERVAL': 0}
+        app.config.update(settings)
+        for key in settings:
+            self.addCleanup(app.config.pop, key)
+        patcher = patch.object(server, '_proxies', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.swift.populate('AUTH_test', 'lfs', 20, size=5)
+        objects = [{'oid': oid(i), 'size': 5} for i in range(20)]
+        status, data = self.post('lfs', 'download', objects)
+        self.assertEqual(status, 200)
+        hosts = set(o['actions']['download']['href'].split('/v1/')[0]
+                    for o in data['objects'])
+        self.assertEqual(hosts, set(proxies))
+        pool = server.get_proxies()
+        self.assertEqual(
+            len([p for p in proxies if pool.latency[p] is not None]), 2)
+
+        # Neither local overload nor slow copies count against a proxy.
+        latency = dict(pool.latency)
+        url = proxies[0] + '/v1/AUTH_test/lfs/' + oid(0)
+        server.observe_swift('HEAD', 'unavailable', 0, url, pool)
+        server.observe_swift('PUT', 201, 0, url, pool)
+        self.assertTrue(pool.healthy[proxies[0]])
+        self.assertEqual(pool.latency, latency)
+        server.observe_swift('HEAD', 'error', 0, url, pool)
+        self.assertFalse(pool.healthy[proxies[0]])
+        pool.check(requests.get)
+
+        # Failing proxies are avoided.
+        pool.observe(proxies[0], ok=False)
+        status, data = self.post('lfs', 'download', objects)
+        hosts = set(o['actions']['download']['href'].split('/v1/')[0]
+                    for o in data['objects'])
+        self.assertEqual(hosts, set(proxies[1:]))
+        pool.check(requests.get)
+        self.assertTrue(pool.healthy[proxies[0]])
+
+    def test_upload(self):
+        objects = [{'oid': oid(0), 'size': 5}, {'oid': oid(7), 'size': 1}]
+        status, data = self.post('lfs', 'upload', objects)
+        self.assertEqual(status, 200)
+        self.assertNotIn('actions', data['objects'][0])
+        self.assertIn('actions', data['objects'][1])
+
+        # Write-only containers are probed.
+        status, data = self.post('dropbox', 'upload', objects)
+        self.assertEqual(status, 200)
+        self.assertIn('actions', data['objects'][0])
+        self.assertEqual(
+            [r[0] for r in self.swift.requests[-3:]], ['HEAD', 'POST', 'HEAD'])
+
+    def test_invalid_auth(self):
+        self.headers['Authorization'] = 'Basic ' + b64encode(
+            b'test;tester:wrong').decode()
+        self.assertEqual(self.post('lfs', 'download', [])[0], 401)
+
+
+if __name__ == '__main__':
+    unittest.main()
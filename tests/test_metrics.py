@@ -0,0 +1,63 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from git_lfs_swift_server import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counter(self):
+        c = metrics.Counter('requests_total', 'Requests.', ('code',))
+        c.inc(('200',))
+        c.inc(('200',), amount=2)
+        c.inc(('a"b\\',))
+        self.assertEqual(c.value(('200',)), 3)
+        self.assertEqual(c.value(('404',)), 0)
+        self.assertRaises(ValueError, c.inc)
+        self.assertEqual(c.render(), '\n'.join([
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{code="200"} 3',
+            'requests_total{code="a\\"b\\\\"} 1']))
+
+    def test_histogram(self):
+        h = metrics.Histogram('duration', 'Duration.', buckets=(1, 0.1))
+        h.observe(0.05)
+        h.observe(0.5)
+        h.observe(2)
+        self.assertEqual(h.count(), 3)
+        with h.time():
+            pass
+        self.assertEqual(h.count(), 4)
+        lines = h.render().split('\n')
+        self.assertEqual(lines[2:5], [
+            'duration_bucket{le="0.1"} 2',
+            'duration_bucket{le="1"} 3',
+            'duration_bucket{le="+Inf"} 4'])
+        self.assertTrue(lines[5].startswith('duration_sum 2.55'))
+        self.assertEqual(lines[6], 'duration_count 4')
+
+    def test_registry(self):
+        r = metrics.Registry()
+        c = r.counter('a_total', 'A.')
+        r.collected('b', 'B.', 'gauge', lambda: [(('x',), 2)], ('l',))
+        c.inc()
+        self.assertEqual(r.render(), '\n'.join([
+            '# HELP a_total A.', '# TYPE a_total counter', 'a_total 1',
+            '# HELP b B.', '# TYPE b gauge', 'b{l="x"} 2', '']))
+        r.clear()
+        self.assertEqual(c.value(), 0)
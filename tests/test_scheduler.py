@@ -0,0 +1,225 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+import time
+import unittest
+
+from git_lfs_swift_server.scheduler import (
+    AsyncFairScheduler, FairQueue, FairScheduler, WeightError)
+
+
+class TestFairQueue(unittest.TestCase):
+
+    def drain(self, q):
+        order = []
+        job = q.get()
+        while job is not None:
+            order.append(job[1])
+            q.done(job[0])
+            job = q.get()
+        return order
+
+    def test_round_robin(self):
+        q = FairQueue()
+        for i in range(4):
+            q.put('a', 'a{}'.format(i))
+        q.put('b', 'b0')
+        q.put('b', 'b1')
+        self.assertEqual(len(q), 6)
+        self.assertEqual(q.depths(), {'a': 4, 'b': 2})
+        self.assertEqual(self.drain(q), ['a0', 'b0', 'a1', 'b1', 'a2', 'a3'])
+        self.assertEqual(q.depths(), {})
+        self.assertEqual(q.running, {})
+
+    def test_weights(self):
+        q = FairQueue(weight=lambda t: 2 if t == 'a' else 1)
+        for i in range(6):
+            q.put('a', 'a{}'.format(i))
+            q.put('b', 'b{}'.format(i))
+        self.assertEqual(
+            self.drain(q)[:6], ['a0', 'b0', 'a1', 'a2', 'b1', 'a3'])
+
+    def test_idle_tenants_get_no_credit(self):
+        q = FairQueue()
+        q.put('a', 'a0')
+        self.assertEqual(self.drain(q), ['a0'])
+        for i in range(3):
+            q.put('b', 'b{}'.format(i))
+        for _ in range(2):
+            q.done(q.get()[0])
+        # a has been idle meanwhile, so b is not starved.
+        q.put('a', 'a1')
+        q.put('a', 'a2')
+        self.assertEqual(self.drain(q), ['a1', 'b2', 'a2'])
+
+    def test_max_running(self):
+        q = FairQueue(max_running=1)
+        q.put('a', 'a0')
+        q.put('a', 'a1')
+        q.put('b', 'b0')
+        first = q.get()
+        self.assertEqual(first[:2], ('a', 'a0'))
+        self.assertEqual(q.get()[:2], ('b', 'b0'))
+        self.assertIsNone(q.get())
+        self.assertEqual(q.running, {'a': 1, 'b': 1})
+        q.done('a')
+        self.assertEqual(q.get()[:2], ('a', 'a1'))
+
+    def test_invalid_weight(self):
+        q = FairQueue(weight=lambda t: -1 if t == 'a' else 1)
+        q.put('a', 'a0')
+        q.put('b', 'b0')
+        with self.assertRaises(WeightError) as cm:
+            q.get()
+        self.assertEqual((cm.exception.tenant, cm.exception.item),
+                         ('a', 'a0'))
+        self.assertIsInstance(cm.exception.__cause__, ValueError)
+        q.done('a')
+        self.assertEqual(q.get()[:2], ('b', 'b0'))
+
+
+class TestFairScheduler(unittest.TestCase):
+
+    def test_small_tenant_is_not_starved(self):
+        waits = []
+        scheduler = FairScheduler(
+            1, observe=lambda tenant, seconds: waits.append(tenant))
+        order = []
+        lock = threading.Lock()
+
+        def job(name):
+            time.sleep(0.002)
+            with lock:
+                order.append(name)
+            return name
+
+        big = [scheduler.submit('big', job, 'big') for _ in range(50)]
+        small = [scheduler.submit('small', job, 'small') for _ in range(2)]
+        self.assertEqual([f.result() for f in small], ['small'] * 2)
+        # At most one job of the big tenant runs between the small ones.
+        self.assertLess(order.index('small'), 3)
+        self.assertLess(len(order) - order.count('small'), 5)
+        for f in big:
+            f.result()
+        self.assertEqual(len(waits), 52)
+        self.assertEqual(scheduler.depths(), {})
+
+    def test_max_running_and_errors(self):
+        scheduler = FairScheduler(4, max_running=2)
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def job():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.005)
+            with lock:
+                running.pop()
+
+        futures = [scheduler.submit('a', job) for _ in range(10)]
+        for f in futures:
+            f.result()
+        self.assertEqual(max(peak), 2)
+
+        def fail():
+            raise ValueError('failed')
+        with self.assertRaises(ValueError):
+            scheduler.submit('a', fail).result()
+
+    def test_invalid_weight(self):
+        scheduler = FairScheduler(
+            1, weight=lambda t: {'a': 0, 'b': 'x'}.get(t, 1))
+        for tenant, error in ('a', ZeroDivisionError), ('b', TypeError):
+            with self.assertRaises(WeightError) as cm:
+                scheduler.submit(tenant, time.sleep, 0).result(timeout=5)
+            self.assertIsInstance(cm.exception.__cause__, error)
+        # The worker survives.
+        self.assertEqual(scheduler.submit('c', len, 'ok').result(5), 2)
+        self.assertEqual(scheduler.running(), {})
+
+    def test_cancel(self):
+        scheduler = FairScheduler(1)
+        event = threading.Event()
+        calls = []
+        first = scheduler.submit('a', event.wait)
+        second = scheduler.submit('a', calls.append, 1)
+        self.assertTrue(second.cancel())
+        event.set()
+        first.result()
+        scheduler.submit('a', calls.append, 2).result()
+        self.assertEqual(calls, [2])
+        self.assertEqual(scheduler.running(), {})
+
+
+class TestAsyncFairScheduler(unittest.TestCase):
+
+    def test_order_and_limit(self):
+        scheduler = AsyncFairScheduler(2)
+        order = []
+        active = []
+
+        async def job(name):
+            active.append(name)
+            self.assertLessEqual(len(active), 2)
+            await asyncio.sleep(0.001)
+            active.remove(name)
+            order.append(name)
+            return name
+
+        async def main():
+            big = [asyncio.ensure_future(scheduler.run('big', job, 'big'))
+                   for _ in range(20)]
+            small = await scheduler.run('small', job, 'small')
+            self.assertLess(len(order), 4)
+            await asyncio.gather(*big)
+            return small
+
+        self.assertEqual(asyncio.run(main()), 'small')
+        self.assertEqual(scheduler.depths(), {})
+        self.assertEqual(scheduler.running(), {})
+
+    def test_cancel(self):
+        scheduler = AsyncFairScheduler(1)
+
+        async def main():
+            event = asyncio.Event()
+            first = asyncio.ensure_future(scheduler.run('a', event.wait))
+            second = asyncio.ensure_future(
+                scheduler.run('a', asyncio.sleep, 0))
+            await asyncio.sleep(0)
+            second.cancel()
+            event.set()
+            await first
+            with self.assertRaises(asyncio.CancelledError):
+                await second
+            self.assertEqual(
+                await scheduler.run('a', asyncio.sleep, 0, 'done'), 'done')
+
+        asyncio.run(main())
+        self.assertEqual(scheduler.running(), {})
+
+    def test_invalid_weight(self):
+        scheduler = AsyncFairScheduler(1, weight=lambda t: 0)
+
+        async def main():
+            with self.assertRaises(WeightError):
+                await scheduler.run('a', asyncio.sleep, 0)
+
+        asyncio.run(main())
+        self.assertEqual(scheduler.running(), {})
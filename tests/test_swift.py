@@ -0,0 +1,293 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+import unittest
+
+import httpx
+from mock import Mock, patch
+from requests import ConnectionError
+from requests.exceptions import ChunkedEncodingError
+
+from git_lfs_swift_server.swift import (
+    AsyncSessionPool, CircuitBreaker, EndpointUnavailable, ProxyPool,
+    SessionPool)
+
+
+class TestSessionPool(unittest.TestCase):
+
+    def test_session_per_endpoint(self):
+        pool = SessionPool(pool_size=2)
+        s1 = pool.session('https://proxy1/v1/AUTH_a/c/o')
+        self.assertIs(s1, pool.session('https://proxy1/v1/AUTH_b/c'))
+        self.assertIsNot(s1, pool.session('https://proxy2/v1/AUTH_a/c/o'))
+        self.assertIsNot(s1, pool.session('http://proxy1/v1/AUTH_a/c/o'))
+        adapter = s1.get_adapter('https://proxy1/')
+        self.assertEqual(adapter._pool_maxsize, 2)
+
+        pool.close()
+        self.assertIsNot(s1, pool.session('https://proxy1/v1/AUTH_a/c/o'))
+
+    @patch('git_lfs_swift_server.swift.requests.Session.head')
+    def test_request_timeout(self, m):
+        pool = SessionPool(timeout=(1, 2))
+        pool.request('HEAD', 'https://proxy/o', headers={})
+        m.assert_called_once_with('https://proxy/o', headers={},
+                                  timeout=(1, 2))
+
+        m.reset_mock()
+        pool.request('HEAD', 'https://proxy/o', timeout=5)
+        m.assert_called_once_with('https://proxy/o', timeout=5)
+
+    def test_no_keepalive(self):
+        pool = SessionPool(keepalive=False)
+        self.assertEqual(
+            pool.session('https://proxy/o').headers['Connection'], 'close')
+
+    @patch('git_lfs_swift_server.swift.time.sleep')
+    @patch('git_lfs_swift_server.swift.requests.Session.head')
+    def test_retries(self, m, sleep):
+        pool = SessionPool(retries=2, backoff=1, backoff_max=3)
+        ok = Mock(status_code=200)
+        m.side_effect = [Mock(status_code=503, headers={}),
+                         ConnectionError, ok]
+        self.assertIs(pool.request('HEAD', 'https://proxy/o'), ok)
+        self.assertEqual(m.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertLessEqual(sleep.call_args_list[0][0][0], 1)
+        self.assertLessEqual(sleep.call_args_list[1][0][0], 2)
+
+        # Client errors are not retried.
+        m.reset_mock()
+        m.side_effect = [Mock(status_code=404), ok]
+        self.assertEqual(pool.request('HEAD', 'https://proxy/o').status_code,
+                         404)
+        self.assertEqual(m.call_count, 1)
+
+        # The last response or error is returned.
+        overloaded = Mock(status_code=429, headers={'retry-after': '2'})
+        m.side_effect = [overloaded] * 3
+        self.assertIs(pool.request('HEAD', 'https://proxy/o'), overloaded)
+        self.assertEqual(sleep.call_args[0][0], 2)
+        m.side_effect = ConnectionError
+        self.assertRaises(
+            ConnectionError, pool.request, 'HEAD', 'https://proxy/o')
+
+    @patch('git_lfs_swift_server.swift.requests.Session.head')
+    def test_circuit_breaker(self, m):
+        pool = SessionPool(breaker_threshold=2, breaker_timeout=10)
+        m.return_value = Mock(status_code=500)
+        with patch('time.monotonic', Mock(return_value=100)):
+            pool.request('HEAD', 'https://proxy/o')
+            self.assertTrue(pool.breaker('https://proxy/').closed)
+            pool.request('HEAD', 'https://proxy/o')
+            with self.assertRaises(EndpointUnavailable) as cm:
+                pool.request('HEAD', 'https://proxy/o')
+            self.assertEqual(cm.exception.retry_after, 10)
+            # Other endpoints are not affected.
+            pool.request('HEAD', 'https://other/o')
+        self.assertEqual(m.call_count, 3)
+
+        # A single trial request is allowed after the timeout.
+        with patch('time.monotonic', Mock(return_value=110)):
+            pool.request('HEAD', 'https://proxy/o')
+            self.assertRaises(EndpointUnavailable, pool.request, 'HEAD',
+                              'https://proxy/o')
+        m.return_value = Mock(status_code=200)
+        with patch('time.monotonic', Mock(return_value=120)):
+            pool.request('HEAD', 'https://proxy/o')
+            pool.request('HEAD', 'https://proxy/o')
+        self.assertTrue(pool.breaker('https://proxy/').closed)
+
+    @patch('git_lfs_swift_server.swift.requests.Session.head')
+    def test_interrupted_trial(self, m):
+        pool = SessionPool(breaker_threshold=1, breaker_timeout=10)
+        m.side_effect = ConnectionError
+        with patch('time.monotonic', Mock(return_value=100)):
+            self.assertRaises(
+                ConnectionError, pool.request, 'HEAD', 'https://proxy/o')
+        # An interrupted trial lets the next request through.
+        m.side_effect = KeyboardInterrupt
+        with patch('time.monotonic', Mock(return_value=110)):
+            self.assertRaises(
+                KeyboardInterrupt, pool.request, 'HEAD', 'https://proxy/o')
+            m.side_effect = ChunkedEncodingError
+            self.assertRaises(ChunkedEncodingError, pool.request, 'HEAD',
+                              'https://proxy/o')
+            # Other errors of a trial open the circuit again.
+            self.assertRaises(EndpointUnavailable, pool.request, 'HEAD',
+                              'https://proxy/o')
+        m.side_effect = None
+        m.return_value = Mock(status_code=200)
+        with patch('time.monotonic', Mock(return_value=120)):
+            pool.request('HEAD', 'https://proxy/o')
+        self.assertTrue(pool.breaker('https://proxy/').closed)
+
+    @patch('git_lfs_swift_server.swift.requests.Session.head')
+    def test_concurrency_limit(self, m):
+        pool = SessionPool(max_concurrency=1, queue_timeout=0.01)
+        entered = threading.Event()
+        release = threading.Event()
+
+        def head(url, **kwargs):
+            entered.set()
+            release.wait(5)
+            return Mock(status_code=200)
+
+        m.side_effect = head
+        t = threading.Thread(
+            target=pool.request, args=('HEAD', 'https://proxy/o'))
+        t.start()
+        entered.wait(5)
+        self.assertRaises(
+            EndpointUnavailable, pool.request, 'HEAD', 'https://proxy/o2')
+        release.set()
+        t.join()
+        pool.request('HEAD', 'https://proxy/o2')
+        self.assertEqual(m.call_count, 2)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(threshold=2, timeout=1)
+        breaker.record(False)
+        breaker.record(True)
+        breaker.record(False)
+        self.assertTrue(breaker.closed)
+        breaker.record(False)
+        self.assertFalse(breaker.closed)
+
+
+class TestProxyPool(unittest.TestCase):
+
+    def test_best(self):
+        pool = ProxyPool(['https://p1/', 'https://p2'], alpha=0.5)
+        # Proxies without latency are tried first.
+        self.assertEqual(pool.best(), 'https://p1')
+        pool.observe('https://p1', 0.2)
+        self.assertEqual(pool.best(), 'https://p2')
+        pool.observe('https://p2', 0.1)
+        self.assertEqual(pool.best(), 'https://p2')
+        pool.observe('https://p2', 0.5)
+        self.assertAlmostEqual(pool.latency['https://p2'], 0.3)
+        pool.observe('https://p2')
+        self.assertAlmostEqual(pool.latency['https://p2'], 0.3)
+        self.assertEqual(pool.best(), 'https://p1')
+        self.assertEqual(
+            pool.route('https://lb:8080/v1/AUTH_a/c/o?x=1'),
+            'https://p1/v1/AUTH_a/c/o?x=1')
+        self.assertEqual(pool.proxy('https://p1/v1/AUTH_a'), 'https://p1')
+        self.assertIsNone(pool.proxy('https://lb/v1/AUTH_a'))
+
+        # Failed proxies are avoided until their next health check.
+        pool.observe('https://p1', ok=False)
+        self.assertEqual(pool.best(), 'https://p2')
+        self.assertEqual(
+            set(pool.pick(str(i)) for i in range(10)), {'https://p2'})
+        pool.observe('https://p2', ok=False)
+        self.assertEqual(pool.candidates(), pool.proxies)
+
+        get = Mock(side_effect=[Mock(status_code=200), ConnectionError])
+        pool.check(get, timeout=1)
+        get.assert_called_with('https://p2/healthcheck', timeout=1)
+        self.assertEqual(pool.healthy, {'https://p1': True,
+                                        'https://p2': False})
+
+    def test_retry(self):
+        # Without health checks, failed proxies get trial requests.
+        pool = ProxyPool(['https://p1', 'https://p2'], retry=10)
+        pool.observe('https://p2', 0.1)
+        with patch('time.monotonic', Mock(return_value=100)):
+            pool.observe('https://p1', ok=False)
+            self.assertEqual(pool.best(), 'https://p2')
+        with patch('time.monotonic', Mock(return_value=110)):
+            self.assertEqual(pool.best(), 'https://p1')
+            # Only a single one.
+            self.assertEqual(pool.best(), 'https://p2')
+            self.assertEqual(pool.candidates(), ['https://p2'])
+            pool.observe('https://p1', ok=False)
+        with patch('time.monotonic', Mock(return_value=120)):
+            self.assertEqual(pool.best(), 'https://p1')
+            pool.observe('https://p1', 0.2)
+        self.assertTrue(pool.healthy['https://p1'])
+        self.assertEqual(pool.candidates(), pool.proxies)
+
+    def test_pick(self):
+        pool = ProxyPool(['https://p1', 'https://p2', 'https://p3'])
+        self.assertEqual(pool.pick('a'), pool.pick('a'))
+        self.assertEqual(
+            set(pool.pick(str(i)) for i in range(30)), set(pool.proxies))
+        self.assertEqual(pool.route('url/c/o', 'a'), 'url/c/o')
+
+
+class TestAsyncSessionPool(unittest.TestCase):
+
+    def test_retries(self):
+        responses = [httpx.Response(503), httpx.ConnectError('down'),
+                     httpx.Response(200)]
+
+        async def head(self, url, **kwargs):
+            r = responses.pop(0)
+            if isinstance(r, Exception):
+                raise r
+            return r
+
+        async def run():
+            pool = AsyncSessionPool(retries=2, backoff=0, max_concurrency=1)
+            try:
+                return await pool.request('HEAD', 'https://proxy/o')
+            finally:
+                await pool.close()
+
+        with patch('httpx.AsyncClient.head', head):
+            self.assertEqual(asyncio.run(run()).status_code, 200)
+        self.assertEqual(responses, [])
+
+    def test_cancelled_trial(self):
+        started = []
+
+        async def head(self, url, **kwargs):
+            started.append(url)
+            if len(started) == 1:
+                raise httpx.ConnectError('down')
+            if len(started) == 2:
+                await asyncio.sleep(10)
+            return httpx.Response(200)
+
+        async def run():
+            pool = AsyncSessionPool(breaker_threshold=1, breaker_timeout=0.1)
+            try:
+                with self.assertRaises(httpx.ConnectError):
+                    await pool.request('HEAD', 'https://proxy/o')
+                await asyncio.sleep(0.15)
+                trial = asyncio.ensure_future(
+                    pool.request('HEAD', 'https://proxy/o'))
+                await asyncio.sleep(0.01)
+                trial.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await trial
+                return await pool.request('HEAD', 'https://proxy/o')
+            finally:
+                await pool.close()
+
+        with patch('httpx.AsyncClient.head', head):
+            self.assertEqual(asyncio.run(run()).status_code, 200)
+        self.assertEqual(len(started), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
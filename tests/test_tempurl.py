@@ -0,0 +1,51 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import hmac
+import unittest
+
+from git_lfs_swift_server import tempurl
+
+
+class TestTempURL(unittest.TestCase):
+
+    def test_expiry(self):
+        self.assertEqual(tempurl.expiry(0, 3600), 3600)
+        self.assertEqual(tempurl.expiry(1, 3600), 3660)
+        self.assertEqual(tempurl.expiry(59.5, 3600), 3660)
+
+    def test_sign(self):
+        signer = tempurl.TempURLSigner('secret')
+        expected = hmac.new(
+            b'secret', b'GET\n3600\n/v1/AUTH_a/c/o',
+            hashlib.sha256).hexdigest()
+        self.assertEqual(
+            signer.sign('GET', 3600, '/v1/AUTH_a/c/o'), expected)
+        self.assertEqual(
+            signer.sign_many('GET', 3600, ['/v1/AUTH_a/c/o'] * 2),
+            [expected] * 2)
+        self.assertNotEqual(
+            signer.sign('PUT', 3600, '/v1/AUTH_a/c/o'), expected)
+        self.assertEqual(signer._cache.stats()['misses'], 2)
+
+    def test_query(self):
+        self.assertEqual(
+            tempurl.query('sig', 3600),
+            '?temp_url_sig=sig&temp_url_expires=3600')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# coding=utf-8
+# Copyright 2017 Christopher Bartz <bartz@dkrz.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import unittest
+
+from mock import patch
+
+from git_lfs_swift_server import tracing
+
+
+class TestTracing(unittest.TestCase):
+
+    def test_spans(self):
+        self.assertIsNone(tracing.current())
+        trace = tracing.begin('batch', sample_rate=1)
+        self.assertIs(tracing.current(), trace)
+        self.assertTrue(trace.sampled)
+        with trace.span('auth', user='u'):
+            pass
+
+        def check():
+            tracing.current().add('swift', trace.start + 0.001, 0.002,
+                                  status=200)
+
+        with ThreadPoolExecutor(2) as executor:
+            for _ in range(2):
+                executor.submit(contextvars.copy_context().run, check)
+        self.assertTrue(tracing.end(trace))
+        self.assertIsNone(tracing.current())
+
+        d = trace.to_dict()
+        self.assertEqual(d['name'], 'batch')
+        self.assertFalse(d['slow'])
+        self.assertEqual([s[0] for s in d['spans']],
+                         ['auth', 'swift', 'swift'])
+        self.assertEqual(d['spans'][0][3], {'user': 'u'})
+        self.assertEqual(d['spans'][1], ['swift', 1.0, 2.0, {'status': 200}])
+
+    def test_sampling(self):
+        with patch('random.random', return_value=0.5):
+            trace = tracing.begin('batch', sample_rate=0.4)
+            self.assertFalse(trace.sampled)
+            self.assertFalse(tracing.end(trace, slow_threshold=60))
+            trace = tracing.begin('batch', sample_rate=0.4)
+            # Slow traces are kept, too.
+            self.assertTrue(tracing.end(trace, slow_threshold=1e-9))
+            self.assertTrue(trace.slow)
+            trace = tracing.begin('batch', sample_rate=0.6)
+            self.assertTrue(tracing.end(trace))
+
+    def test_profile(self):
+        trace = tracing.begin('batch', sample_rate=1, profile=True)
+        self.assertIsNotNone(trace.profiler)
+        tracing.end(trace)
+        trace = tracing.begin('batch', sample_rate=0, profile=True)
+        self.assertIsNone(trace.profiler)
+        tracing.end(trace)
+
+
+if __name__ == '__main__':
+    unittest.main()